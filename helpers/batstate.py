@@ -1,28 +1,27 @@
 #!/usr/bin/python3
 
-# Read battery state of all stations, write into file
+# Read battery state of all stations placed one by one on master station,
+# append into file (CSV, JSONL if file ends with .jsonl). Stations already
+# in the file are skipped. Same as: siadmin.py survey <file>
+#
+# Usage: batstate.py [file]
 
+import sys
 import siadmin as sa
 import sportident as si
 
-filename = 'si_batstat.csv'
-r = ''
+filename = sys.argv[1] if len(sys.argv) > 1 else 'si_survey.csv'
 
-with open(filename, 'a') as wfile:
-    ports = si.station_detect()
-    siadm = sa.SiAdmin(ports[0])
-    siadm.setremote()
-    wfile.write("\n\n#Code;Mode;Voltage;Date\n")
-    while True:
-        r = input("Enter q to quit: ")
-        if r.lower() == 'q': break
-        try:
-            mode,code = siadm.getmodecn()
-            bvolt = siadm.getbatvoltage()
-            bdate = siadm.getbatdate()
-            print("{};{};{:4.2f};{}".format(code, si.MODES[mode], bvolt, bdate))
-            wfile.write("{};{};{:4.2f};{}\n".format(code, si.MODES[mode], bvolt, bdate))
-        except si.SiException:
-            print("Station do not communicate.")
+try:
+    sa.surveyed(filename, filename.endswith('.jsonl'))     # Refuse file in other format early
+except si.SiException as e:
+    print(e)
+    sys.exit(1)
 
-wfile.close()
+ports = si.station_detect()
+siadm = sa.SiAdmin(ports[0])
+siadm.setremote()
+print("Place stations on master station, Ctrl-C to quit.")
+count = sa.run_survey(siadm, filename, sys.stdout)
+siadm.close()
+print("{} stations appended to {}".format(count, filename))
@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+
+# Benchmark suite: codec hot paths (micro) and commands against
+# simulated station (macro). Results are written as JSON.
+#
+# Usage: bench.py [micro|macro|all] [-n <repeat>] [-o <file>]
+
+import sys, io, json, time, timeit, random, platform, statistics, logging, datetime
+import sportident as si
+import siadmin, sisim
+
+SEED = 1
+BACKUP_RECORDS = 1000       # Backup records downloaded in macro benchmark
+
+## Micro ## --------------------------------
+def timed(func, number):
+    '''Best time of one call in microseconds.'''
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6
+
+def micro():
+    '''Time codec functions, returns {name: {'us': time of one call, 'number': calls}}.'''
+    rnd = random.Random(SEED)
+    results = {}
+    def add(name, func, number):
+        results[name] = {'us': round(timed(func, number), 3), 'number': number}
+
+    for size in (4, 133, 261):
+        data = bytes(rnd.getrandbits(8) for i in range(size))
+        add('crc_l/{}'.format(size), lambda: si.crc_l(size, data), 100000 // size)
+    data = bytes(rnd.getrandbits(8) for i in range(133))
+    add('crc/133', lambda: si.crc(data), 1000)
+
+    station = si.SiBase('bench')
+    add('frame/getdata', lambda: station.frame(si.C_GETDATA, (0, 0x80)), 10000)
+    reply = sisim.mkframe(si.C_GETDATA, 31, bytes((0,)) + bytes(rnd.getrandbits(8) for i in range(128)))
+    def unframe():
+        station.decoder.feed(reply)
+        station.unframe()
+    add('unframe/getdata', unframe, 2000)
+    stream = b''.join(sisim.mkframe(si.C_PUNCH, 31, bytes(rnd.getrandbits(8) for i in range(11)))
+                      for n in range(100))
+    def decode():
+        decoder = si.FrameDecoder()
+        decoder.feed(stream)
+        for frame in decoder: si.autosend_event(frame)
+    add('events/100', decode, 50)
+
+    punch = bytes((0x04, 31, 0x8c, 0xa0))
+    add('punch4', lambda: si.punch4(punch), 20000)
+    card = si.Card(8123456, 30, si.Punch(0, 2, 36000), si.Punch(0, 2, 40000), None,
+                   tuple(si.Punch(31 + i, 2, 36100 + 60 * i) for i in range(50)))
+    memory = sisim.card_memory(card)
+    blocks = {bn: memory[bn*si.CARD_BLOCK:(bn+1)*si.CARD_BLOCK] for bn in range(8)}
+    add('parse_card/siac50', lambda: si.parse_card(si.C_GETSI8, blocks), 1000)
+    si5 = sisim.card_memory(si.Card(212345, 5, None, None, None, tuple(si.Punch(31 + i, None, 36100 + i) for i in range(30))))
+    add('parse_card/si5', lambda: si.parse_card(si.C_GETSI5, {0: si5}), 1000)
+    try:
+        si.decode_backup(b'')       # Imports NumPy, if available
+    except si.SiException:
+        pass
+    else:
+        dump = bytes(rnd.getrandbits(8) for i in range(8 * 10000))
+        add('decode_backup/10000', lambda: si.decode_backup(dump), 20)
+    return results
+
+## Macro ## --------------------------------
+def measure(func, repeat, setup=None):
+    '''Wall time of func in milliseconds: median, min, max of repeat runs.'''
+    times = []
+    for n in range(repeat):
+        if setup: setup()
+        start = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - start) * 1000)
+    return {'ms': round(statistics.median(times), 3), 'min': round(min(times), 3),
+            'max': round(max(times), 3), 'n': repeat}
+
+def macro(repeat):
+    '''Time commands against simulated master and remote station.'''
+    results = {}
+    remote = sisim.SimStation(cn=45, serial=500124)
+    t = datetime.datetime(2026, 5, 16, 10, 0, 0)
+    for i in range(BACKUP_RECORDS):
+        remote.punch(500000 + i, t + datetime.timedelta(seconds=i))
+    with sisim.Simulator(remote=remote, seed=SEED) as sim:
+        stations = []
+        def opensi():
+            stations.append(siadmin.SiAdmin(sim.tty, cache=None))
+        results['open'] = measure(opensi, repeat, lambda: stations and stations.pop().close())
+        siadm = stations[0]
+        results['setremote'] = measure(siadm.setremote, repeat)
+        cold = siadm.sysdata.invalidate
+        for name in ('getmodecn', 'getserial', 'getfwversion', 'getbatall', 'getbackptr', 'getime'):
+            results[name] = measure(getattr(siadm, name), repeat, cold)
+        siadm.getmodecn()
+        results['getmodecn/cached'] = measure(siadm.getmodecn, repeat)
+        results['setcnmode'] = measure(lambda: siadm.setcnmode(45), repeat)
+        results['setprot'] = measure(lambda: siadm.setprot({'extprot': True, 'autosend': False}), repeat)
+        results['setbatdate'] = measure(lambda: siadm.setbatdate(datetime.date(2026, 1, 1)), repeat)
+        results['setime'] = measure(siadm.setime, repeat)
+        results['beep'] = measure(siadm.beep, repeat)
+        results['commands/setup'] = measure(
+            lambda: siadmin.run_commands(siadm, 'wcn 45 wprot 1,0 wtime rbat rcn'.split(), io.StringIO()),
+            repeat, cold)
+        results['backup/{}'.format(BACKUP_RECORDS)] = measure(lambda: siadm.getbackup(io.BytesIO()),
+                                                             max(repeat // 5, 1))
+        siadm.close()
+    return results
+
+## Main ## ---------------------------------
+def main():
+    levels = 'all'
+    repeat = 20
+    outfile = None
+    args = sys.argv[1:]
+    while args:
+        arg = args.pop(0)
+        if arg == '-n':
+            repeat = int(args.pop(0))
+        elif arg == '-o':
+            outfile = args.pop(0)
+        elif arg in ('micro', 'macro', 'all'):
+            levels = arg
+        else:
+            print("Usage: bench.py [micro|macro|all] [-n <repeat>] [-o <file>]")
+            return 1
+    logging.basicConfig(level=logging.ERROR)
+    report = {'python': platform.python_version(), 'machine': platform.machine(),
+              'date': datetime.datetime.now().isoformat(timespec='seconds'), 'seed': SEED}
+    if levels in ('micro', 'all'):
+        report['micro'] = micro()
+    if levels in ('macro', 'all'):
+        report['macro'] = macro(repeat)
+    text = json.dumps(report, indent=2)
+    if outfile:
+        with open(outfile, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    sys.exit(main())
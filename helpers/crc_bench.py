@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+
+# Check table driven CRC against the original bit by bit algorithm
+# and measure the speedup.
+
+import random, timeit
+import sportident as si
+
+def crc_l_bitwise(length, data):
+    """Original bit by bit CRC computation (reference)."""
+    Polynom = 0x8005;
+    Bitmask = 0x8000;
+    Intmask = 0xFFFF;
+
+    p = 0
+    if length < 2: return 0
+    sum0 = data[p]
+    p += 1
+    sum0 = (sum0 << 8) + data[p]
+    p += 1
+
+    if length == 2: return sum0
+
+    i = length >> 1
+    while i > 0:
+        if i > 1:
+            sum1 = data[p]
+            p += 1
+            sum1 = ((sum1 << 8) & Intmask) + data[p]
+            p += 1
+        else:
+            if length & 1:
+                sum1 = data[p] << 8
+                p += 1
+            else:
+                sum1 = 0
+
+        for k in range(0,16):
+            if sum0 & Bitmask:
+                sum0 = (sum0 << 1) & Intmask
+                if sum1 & Bitmask: sum0 = sum0 + 1 & Intmask
+                sum0 ^= Polynom
+            else:
+                sum0 = (sum0 << 1) & Intmask
+                if sum1 & Bitmask: sum0 = sum0 + 1 & Intmask
+            sum1 = (sum1 << 1) & Intmask
+        i -= 1
+    return sum0
+
+def check(count=20000, seed=1):
+    '''Compare both implementations on random data of random length.'''
+    rnd = random.Random(seed)
+    for n in range(count):
+        data = bytes(rnd.getrandbits(8) for i in range(rnd.randint(0, 300)))
+        # length may be shorter than data, as in Si.checkcrc
+        length = rnd.randint(0, len(data))
+        for l in (len(data), length):
+            if si.crc_l(l, data) != crc_l_bitwise(l, data):
+                raise AssertionError("CRC mismatch, length {}: {}".format(l, data.hex()))
+    print("OK: {} random frames identical.".format(count))
+
+def bench():
+    '''Time both implementations on typical frame sizes.'''
+    rnd = random.Random(2)
+    for size in (4, 10, 133, 261):
+        data = bytes(rnd.getrandbits(8) for i in range(size))
+        number = 200000 // size
+        old = min(timeit.repeat(lambda: crc_l_bitwise(size, data), number=number, repeat=5)) / number
+        new = min(timeit.repeat(lambda: si.crc_l(size, data), number=number, repeat=5)) / number
+        print("{:4d} bytes: bitwise {:8.2f} us, table {:7.2f} us, speedup {:4.1f}x".format(
+            size, old * 1e6, new * 1e6, old / new))
+
+if __name__ == '__main__':
+    check()
+    bench()
@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+
+# Check FrameDecoder on split, doubled STX and bad CRC input.
+
+import random
+import sportident as si
+
+def frame(command, data, cn=None):
+    '''Framed station reply (with CN if given), as sent on the wire.'''
+    body = bytearray((command, len(data) + (2 if cn is not None else 0)))
+    if cn is not None: body += cn.to_bytes(2, 'big')
+    body += data
+    crcsum = si.crc(body)
+    return bytes((si.STX,)) + bytes(body) + bytes((crcsum >> 8, crcsum & 0xff, si.ETX))
+
+def decode(chunks):
+    '''Feed chunks one by one, return decoded frames and the decoder.'''
+    d = si.FrameDecoder()
+    frames = []
+    for c in chunks:
+        d.feed(c)
+        frames += list(d)
+    return frames, d
+
+def expect(name, got, want):
+    if got != want:
+        raise AssertionError("{}: got {}, expected {}".format(name, got, want))
+
+def check_split(count=2000, seed=1):
+    '''Stream of frames and control bytes split at random points.'''
+    rnd = random.Random(seed)
+    for n in range(count):
+        want = []
+        wire = bytearray()
+        for i in range(rnd.randint(1, 5)):
+            if rnd.random() < 0.2:
+                c = rnd.choice((si.ACK, si.NAK))
+                want.append(si.Frame(c, None, b''))
+                wire.append(c)
+            else:
+                data = bytes(rnd.getrandbits(8) for i in range(rnd.randint(0, 128)))
+                cn = rnd.randint(1, 255)
+                want.append(si.Frame(0xE1, cn, data))
+                wire += frame(0xE1, data, cn)
+        cuts = sorted(rnd.randint(0, len(wire)) for i in range(rnd.randint(0, 6)))
+        chunks = [wire[a:b] for a, b in zip([0] + cuts, cuts + [len(wire)])]
+        frames, d = decode(chunks)
+        expect("split", frames, want)
+    print("OK: {} split streams decoded.".format(count))
+
+def check_missing():
+    '''missing() counts to the end of the frame, also after doubled STX.'''
+    wire = bytes((si.WAKE, si.STX)) + frame(0xE1, bytes(range(10)), 1)
+    for cut in range(len(wire)):
+        d = si.FrameDecoder()
+        d.feed(wire[:cut])
+        expect("no frame", d.next(), None)
+        left = len(wire) - cut
+        need = d.missing()
+        if cut >= 5: expect("missing at {}".format(cut), need, left)   # Length byte received
+        elif not need <= left: raise AssertionError("missing at {}: {}".format(cut, need))
+        d.feed(wire[cut:])
+        expect("doubled STX", d.next(), si.Frame(0xE1, 1, bytes(range(10))))
+    print("OK: missing() with doubled STX.")
+
+def check_badcrc():
+    '''Frame with bad CRC is dropped with ACK/NAK bytes inside, next frame is kept.'''
+    good = frame(0xE1, b'\x11\x22', 5)
+    data = bytes((si.ACK, si.NAK, 0x33, si.ACK))
+    bad = bytearray(frame(0xE1, data, 5))
+    bad[-2] ^= 0xFF
+    frames, d = decode([bytes(bad) + good])
+    expect("bad CRC", frames, [si.Frame(0xE1, 5, b'\x11\x22')])
+    expect("badcrc count", d.badcrc, 1)
+    # STX inside the rejected frame starts the resynchronization
+    bad = bytearray(frame(0xE1, bytes((si.NAK,)) + good, 5))
+    bad[-2] ^= 0xFF
+    frames, d = decode([bytes(bad)])
+    expect("resync in frame", frames, [si.Frame(0xE1, 5, b'\x11\x22')])
+    # Control byte right after the rejected frame is kept
+    frames, d = decode([bytes(bad) + bytes((si.ACK,))])
+    expect("ACK after frame", frames[-1], si.Frame(si.ACK, None, b''))
+    print("OK: bad CRC frames dropped.")
+
+if __name__ == '__main__':
+    check_split()
+    check_missing()
+    check_badcrc()
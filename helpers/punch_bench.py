@@ -0,0 +1,58 @@
+#!/usr/bin/python3
+
+# Check vectorized punch decoding against punch4 and measure it
+# on large synthetic dumps. Needs NumPy.
+
+import sys, time
+import numpy as np
+import sportident as si
+
+def synthetic(count, size, seed=1):
+    '''Random punch records (size 4) or backup records (size 8), about 1 % null.'''
+    rnd = np.random.default_rng(seed)
+    r = rnd.integers(0, 256, (count, size), dtype=np.uint8)
+    if size == 4:
+        r[:, 2] = rnd.integers(0, 0xA9, count)          # Time < 43200
+        null = rnd.random(count) < 0.01
+        r[null] = 0xEE
+    else:
+        r[:, 3] = rnd.integers(0, 64, count) << 2 | rnd.integers(0, 4, count)
+        r[:, 4] = (rnd.integers(1, 29, count) << 1 | rnd.integers(0, 2, count)) | rnd.integers(0, 4, count) << 6
+        r[:, 5] = rnd.integers(0, 0xA9, count)
+        empty = rnd.random(count) < 0.01
+        r[empty] = 0xFF
+    return r.tobytes()
+
+def check(count=100000):
+    '''Compare decode_punches with punch4 record by record.'''
+    data = synthetic(count, 4, seed=2)
+    cols = si.decode_punches(data)
+    for i in range(count):
+        p = si.punch4(data[4*i:4*i+4])
+        got = (int(cols['cn'][i]), int(cols['dow'][i]), int(cols['seconds'][i])) if cols['valid'][i] else None
+        if (p and (p.cn, p.dow, int(p.time))) != got:
+            raise AssertionError("Record {} differs: {} {}".format(i, p, got))
+    print("OK: {} records identical.".format(count))
+
+def bench(count):
+    '''Time vectorized decoding of count records and per-record Python decoding.'''
+    vec = {}
+    for name, size, decode in (('punch', 4, si.decode_punches), ('backup', 8, si.decode_backup)):
+        data = synthetic(count, size)
+        start = time.perf_counter()
+        cols = decode(data)
+        vec[name] = time.perf_counter() - start
+        print("{:6s} {:9d} records: vectorized {:7.3f} s ({:5.1f} M rec/s), {} valid".format(
+            name, count, vec[name], count / vec[name] / 1e6, int(cols['valid'].sum())))
+    sample = min(count, 200000)
+    data = synthetic(sample, 4)
+    start = time.perf_counter()
+    for i in range(0, len(data), 4):
+        si.punch4(data[i:i+4])
+    loop = (time.perf_counter() - start) * count / sample
+    print("punch  {:9d} records: punch4 loop {:7.3f} s (extrapolated), speedup {:.0f}x".format(
+        count, loop, loop / vec['punch']))
+
+if __name__ == '__main__':
+    check()
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 5000000)
@@ -0,0 +1,28 @@
+#!/usr/bin/python3
+
+# Print binary wire trace (siadmin.py --trace=<file>) as text.
+#
+# Usage: trace_dump.py <file>
+
+import sys
+import sportident as si
+
+DIRECTIONS = {si.TRACE_IN: '<i<<<', si.TRACE_OUT: '>o>>>', si.TRACE_OPEN: 'open ', si.TRACE_SESSION: '====='}
+
+def main():
+    if len(sys.argv) != 2:
+        print("Usage: trace_dump.py <file>")
+        return 1
+    start = None
+    for t, direction, data in si.read_trace(sys.argv[1]):
+        if start is None: start = t
+        if direction == si.TRACE_SESSION:
+            text = "session"
+        elif direction == si.TRACE_OPEN:
+            text = "{} Bd".format(int.from_bytes(data, 'big'))
+        else:
+            text = data.hex(':') if data else '(timeout)'
+        print("{:10.4f} {} {}".format(t - start, DIRECTIONS.get(direction, '?????'), text))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -10,21 +10,120 @@
 ################################################
 
 import sportident as si
-import sys, time, datetime, logging
+import siexport
+import os, sys, io, time, datetime, logging, serial, json, copy, csv, signal, socket, tempfile
+import concurrent.futures, socketserver
+try:
+    import tomllib
+except ImportError:     # Python < 3.11, JSON config only
+    tomllib = None
+
+## Data conversion ## ---------------------
+##################### ----------------------
+def parse_time(rdata):
+    '''Station time from C_GETTIME reply.'''
+    return si.clock_time(rdata[4:11])
+
+def parse_batdate(data):
+    '''Battery change date from 3 bytes (year, month, day).'''
+    if data[0] < 80: year = 2000 + data[0]
+    else: year = 1900 + data[0]
+    return datetime.date(year, data[1], data[2])
+
+def parse_batstate(capdata, consdata):
+    '''Remaining battery percent from capacity and consumption (4 bytes each).'''
+    capacity = int.from_bytes(capdata[0:4], 'big')
+    logging.debug("Battery capacity: {:.2f} mAh.".format(capacity/3600))
+    consumed = int.from_bytes(consdata[0:4], 'big')
+    logging.debug("Battery consumed: {:.2f} mAh.".format(consumed/3600))
+    return round(100 * (1 - consumed/capacity))
+
+def parse_batvoltage(data):
+    '''Battery voltage from 2 bytes.'''
+    voltage = (data[0] << 8) + data[1]
+    if voltage > 13100: voltage /= 131
+    return voltage / 100
+
+def parse_batemp(data):
+    '''Battery temperature from 2 bytes.'''
+    temper = (data[0] << 8) + data[1]
+    if temper >= 25800:
+        return (temper - 25800) / 92
+    else:
+        return temper / 10
+
+def parse_batall(data):
+    '''Battery data from 63 bytes of system data at O_BATALL.
+       Returns: date, percent, voltage, temperature.'''
+    o = si.O_BATALL
+    return (parse_batdate(data),
+            parse_batstate(data[si.O_BATCAP-o:], data[si.O_BATCONS-o:]),
+            parse_batvoltage(data[si.O_BATVOLT-o:]),
+            parse_batemp(data[si.O_BATTEMP-o:]))
+
+def format_time(t):
+    '''Seconds after midnight as text.'''
+    if t is None: return '--:--:--'
+    return '{:02d}:{:02d}:{:05.2f}'.format(int(t // 3600), int(t % 3600 // 60), t % 60)
+
+def format_event(event):
+    '''Autosend event as text line.'''
+    if event.kind == 'punch':
+        return "Punch:  CN {}, card {}, {} {}".format(event.cn, event.card, DAYS[event.dow], format_time(event.time))
+    if event.kind == 'insert':
+        return "Card inserted: {} (SI{})".format(event.card, event.cardtype)
+    return "Card removed:  {}".format(event.card)
+
+def format_card(card):
+    '''Card readout as text.'''
+    def ptime(punch):
+        return format_time(punch.time if punch else None)
+    lines = ["Card {} (SI{}): check {}, start {}, finish {}, {} punches".format(
+        card.card, card.cardtype, ptime(card.check), ptime(card.start), ptime(card.finish), len(card.punches))]
+    for n, punch in enumerate(card.punches, 1):
+        lines.append("    {:3d}. CN {:3d}  {}".format(n, punch.cn, ptime(punch)))
+    return '\n'.join(lines)
+
+def prot_cpc(cpc, prot):
+    '''Apply protocol parameters (dict) to CPC byte.'''
+    if 'extprot' in prot:
+        cpc = si.set_bit(cpc, 0, prot['extprot'])
+    if 'autosend' in prot:
+        cpc = si.set_bit(cpc, 1, prot['autosend'])
+    if 'handshk' in prot:
+        cpc = si.set_bit(cpc, 2, prot['handshk'])
+    if 'password' in prot:
+        cpc = si.set_bit(cpc, 4, prot['password'])
+    if 'punchread' in prot:
+        cpc = si.set_bit(cpc, 7, prot['punchread'])
+    return cpc
+
+def cnmode_data(cn, mode='Control'):
+    '''Check control number and mode, return system data at O_MODE.'''
+    cn = int(cn)
+    if not 1 <= cn <= 255:
+        raise si.SiException('Control number not in range 1-255.')
+    if mode not in si.MODES:
+        raise si.SiException('Unknown station mode.')
+    return (si.MODES.index(mode), cn)
 
 class SiAdmin(si.Si):
     '''SI Administration tasks'''
 
-    def __init__(self, tty):
-        super().__init__(tty)
+    def __init__(self, tty, **kwargs):
+        super().__init__(tty, **kwargs)
 
     def setremote(self):
         '''Set communication to remote (controlled station).'''
+        self.sysdata.invalidate()
         self.handshake(si.C_SETMSMODE, (si.MODE_REMOTE,))
+        self.switched(si.MODE_REMOTE)
 
     def setlocal(self):
         '''Set communication to local (master station itself).'''
+        self.sysdata.invalidate()
         self.handshake(si.C_SETMSMODE, (si.MODE_LOCAL,))
+        self.switched(si.MODE_LOCAL)
 
     def off(self):
         '''Turn station off.'''
@@ -33,79 +132,41 @@ class SiAdmin(si.Si):
     def getime(self):
         '''Read station time.'''
         self.handshake(si.C_GETTIME)
-        td = self.rdata[7]
-        is_pm = td & 0x01
-        secs = (self.rdata[8] << 8) + self.rdata[9] + is_pm * 43200;
-        subsec = int(self.rdata[10] * 1000000/256)
-        if self.rdata[5] == 0: self.rdata[5] = 1   # Repair not set date
-        if self.rdata[6] == 0: self.rdata[6] = 1   # Repair not set date
-        return datetime.datetime(2000+self.rdata[4], self.rdata[5], self.rdata[6], secs // 3600, (secs % 3600) // 60, secs % 60, subsec)
+        return parse_time(self.rdata)
 
     def getmodecn(self):
         '''Read station mode and number.'''
-        self.handshake(si.C_GETDATA, (si.O_MODE, 2))
-        return self.rdata[5:7]
+        return self.readsys(si.O_MODE, 2)
+
+    def getserial(self):
+        '''Read station serial number.'''
+        self.readsys(si.O_SERIAL, 4)
+        return self.sysdata.serial
 
     def getfwversion(self):
         '''Read firmware version (string).'''
-        self.handshake(si.C_GETDATA, (si.O_FWVER, 3))
-        return bytes(self.rdata[5:8])
+        return self.readsys(si.O_FWVER, 3)
 
     def getbatstate(self):
         '''Read battery status. Returns: Remaining percent.'''
-        self.handshake(si.C_GETDATA, (si.O_BATCONS, 4))
-        consumed = (self.rdata[5] << 24) + (self.rdata[6] << 16) + (self.rdata[7] << 8) + self.rdata[8]
-        logging.debug("Battery consumed: {:.2f} mAh.".format(consumed/3600))
-        self.handshake(si.C_GETDATA, (si.O_BATCAP, 4))
-        capacity = (self.rdata[5] << 24) + (self.rdata[6] << 16) + (self.rdata[7] << 8) + self.rdata[8]
-        logging.debug("Battery capacity: {:.2f} mAh.".format(capacity/3600))
-        return round(100 * (1 - consumed/capacity))
+        return parse_batstate(self.readsys(si.O_BATCAP, 4), self.readsys(si.O_BATCONS, 4))
 
     def getbatvoltage(self):
         '''Read battery voltage.'''
-        self.handshake(si.C_GETDATA, (si.O_BATVOLT, 2))
-        voltage = (self.rdata[5] << 8) + self.rdata[6]
-        if voltage > 13100: voltage /= 131
-        return voltage / 100
+        return parse_batvoltage(self.readsys(si.O_BATVOLT, 2))
 
     def getbatemp(self):
         '''Read battery temperature.'''
-        self.handshake(si.C_GETDATA, (si.O_BATTEMP, 2))
-        temper = (self.rdata[5] << 8) + self.rdata[6]
-        if temper >= 25800:
-            return (temper - 25800) / 92
-        else:
-            return temper / 10
+        return parse_batemp(self.readsys(si.O_BATTEMP, 2))
 
     def getbatdate(self):
         '''Read battery change date.'''
-        self.handshake(si.C_GETDATA, (si.O_BATDATE, 3))
-        if self.rdata[5] < 80: year = 2000 + self.rdata[5]
-        else: year = 1900 + self.rdata[5]
-        return datetime.date(year, self.rdata[6], self.rdata[7])
+        return parse_batdate(self.readsys(si.O_BATDATE, 3))
 
     def getbatall(self):
         '''Read all battery data at once.
            Returns: date, percent, voltage, temperature.'''
-        self.handshake(si.C_GETDATA, (si.O_BATALL, 63))
-        # Date
-        if self.rdata[5] < 80: year = 2000 + self.rdata[5]
-        else: year = 1900 + self.rdata[5]
-        changedate = datetime.date(year, self.rdata[6], self.rdata[7])
-        # Capacity
-        capacity = (self.rdata[3+5] << 24) + (self.rdata[3+6] << 16) + (self.rdata[3+7] << 8) + self.rdata[3+8]
-        logging.debug("Battery capacity: {:.2f} mAh.".format(capacity/3600))
-        # Consumed
-        consumed = (self.rdata[31+5] << 24) + (self.rdata[31+6] << 16) + (self.rdata[31+7] << 8) + self.rdata[31+8]
-        logging.debug("Battery consumed: {:.2f} mAh.".format(consumed/3600))
-        # Voltage
-        voltage = (self.rdata[59+5] << 8) + self.rdata[59+6]
-        if voltage > 13100: voltage /= 131
-        voltage /= 100
-        temper = (self.rdata[61+5] << 8) + self.rdata[61+6]
-        if temper >= 25800: temper = (temper - 25800) / 92
-        else: temper = temper / 10
-        return changedate, round(100 * (1 - consumed/capacity)), voltage, temper
+        return parse_batall(self.readsys(si.O_BATALL, 63))
 
     def beep(self, times=1):
         '''Beep several times.'''
@@ -114,48 +175,156 @@ class SiAdmin(si.Si):
 
     def getprot(self):
         '''Read communication protocol info.'''
-        # Already read during init and saved in class attributes
-        return {'cpc': self.cpc,
-                'extprot': self.extprot,
-                'autosend': self.autosend,
-                'handshk': self.handshk,
-                'password': self.password,
-                'punchread': self.punchread}
+        # Read during init or after mode switch (or taken from cache) and saved in class attributes
+        self.confirmprot()
+        return super().getprot()
 
     def setprot(self, prot={}):
         '''Set communication protocol parameters.'''
-        cpc = self.cpc
-        if 'extprot' in prot:
-            cpc = si.set_bit(cpc, 0, prot['extprot'])
-        if 'autosend' in prot:
-            cpc = si.set_bit(cpc, 1, prot['autosend'])
-        if 'handshk' in prot:
-            cpc = si.set_bit(cpc, 2, prot['handshk'])
-        if 'password' in prot:
-            cpc = si.set_bit(cpc, 4, prot['password'])
-        if 'punchread' in prot:
-            cpc = si.set_bit(cpc, 7, prot['punchread'])
-        self.handshake(si.C_SETDATA, (si.O_PROT, cpc))
+        self.confirmprot()
+        self.setsys(si.O_PROT, (prot_cpc(self.cpc, prot),))
 
     def setcnmode(self, cn, mode='Control'):
         '''Set control number and mode.'''
-        cn = int(cn)
-        if not 1 <= cn <= 255:
-            raise si.SiException('Control number not in range 1-255.')
-        if mode not in si.MODES:
-            raise si.SiException('Unknown station mode.')
-        self.handshake(si.C_SETDATA, (si.O_MODE, si.MODES.index(mode), cn))
+        self.setsys(si.O_MODE, cnmode_data(cn, mode))
 
     def setbatdate(self, date):
         '''Set battery change date.'''
-        self.handshake(si.C_SETDATA, (si.O_BATDATE, date.year % 100, date.month, date.day))
+        self.setsys(si.O_BATDATE, (date.year % 100, date.month, date.day))
+
+    def getbackptr(self):
+        '''Read backup memory pointer (address of next record).'''
+        self.readsys(si.O_BACKPTR, 7)
+        return self.sysdata.backptr
+
+    def getmem(self, addr, num=si.MEM_CHUNK):
+        '''Read num bytes of backup memory from address.'''
+        adr = bytes((addr >> 16 & 0xff, addr >> 8 & 0xff, addr & 0xff))
+        self.handshake(si.C_GETMEM, adr + bytes((num,)))
+        while self.rdata[0] != si.C_GETMEM or self.rdata[4:7] != adr:
+            # Late reply to previous request, the right one should follow
+            if self.siread() != si.DATAOK:
+                raise si.SiException('Backup memory read failed at 0x{:06x}.'.format(addr))
+        return bytes(self.rdata[7:])
+
+    def getbackup(self, wfile, start=si.BACKUP_START, end=None, resumes=3):
+        '''Download backup memory from start up to backup pointer.
+           Raw data are written to wfile as they arrive, failed chunk is
+           read again (resumes times) without starting over.
+           Returns: address following the last byte read.'''
+        if end is None: end = self.getbackptr()
+        addr = self.backaddr = start
+        fails = 0
+        with self.highspeed(end - start):
+            while addr < end:
+                try:
+                    data = self.getmem(addr, min(si.MEM_CHUNK, end - addr))
+                except si.SiException:
+                    fails += 1
+                    if fails > resumes:
+                        raise si.SiException('Backup read failed at 0x{:06x}, {} bytes read.'.format(addr, addr - start))
+                    logging.warning("Backup read failed at 0x{:06x}, resuming.".format(addr))
+                    continue
+                if not data:
+                    break
+                wfile.write(data)
+                addr += len(data)
+                self.backaddr = addr
+        logging.debug("Backup read 0x{:06x} - 0x{:06x}.".format(start, addr))
+        return addr
+
+    def syncbackup(self, wfile, state):
+        '''Download only backup records added since the last sync.
+           state ... StateFile with last read pointer of each station
+                     (key is CN and serial number).
+           Returns: start and end address of new data.'''
+        mode, cn = self.getmodecn()
+        key = '{}:{}'.format(cn, self.getserial())
+        end = self.getbackptr()
+        start = state.get(key, si.BACKUP_START)
+        if not si.BACKUP_START <= start <= end:     # Memory was cleared
+            logging.info("Backup pointer of station {} went back, reading all.".format(cn))
+            start = si.BACKUP_START
+        self.backaddr = start
+        try:
+            self.getbackup(wfile, start, end)
+        finally:
+            state[key] = self.backaddr             # Save progress even on failure
+            state.save()
+        return start, self.backaddr
 
 ## End of class SiAdmin ## -----------------
 
+class AsyncSiAdmin(si.AsyncSi):
+    '''SI Administration tasks, asyncio version of SiAdmin.
+       Create instances with: siadm = await AsyncSiAdmin.open(tty)'''
+
+    async def setremote(self):
+        '''Set communication to remote (controlled station).'''
+        self.sysdata.invalidate()
+        await self.handshake(si.C_SETMSMODE, (si.MODE_REMOTE,))
+        self.switched(si.MODE_REMOTE)
+
+    async def setlocal(self):
+        '''Set communication to local (master station itself).'''
+        self.sysdata.invalidate()
+        await self.handshake(si.C_SETMSMODE, (si.MODE_LOCAL,))
+        self.switched(si.MODE_LOCAL)
+
+    async def off(self):
+        '''Turn station off.'''
+        await self.handshake(si.C_OFF)
+
+    async def beep(self, times=1):
+        '''Beep several times.'''
+        await self.handshake(si.C_BEEP, (times,))
+        return times
+
+    async def getime(self):
+        '''Read station time.'''
+        await self.handshake(si.C_GETTIME)
+        return parse_time(self.rdata)
+
+    async def getmodecn(self):
+        '''Read station mode and number.'''
+        return await self.readsys(si.O_MODE, 2)
+
+    async def getfwversion(self):
+        '''Read firmware version (string).'''
+        return await self.readsys(si.O_FWVER, 3)
+
+    async def getbatall(self):
+        '''Read all battery data at once.
+           Returns: date, percent, voltage, temperature.'''
+        return parse_batall(await self.readsys(si.O_BATALL, 63))
+
+    async def setprot(self, prot={}):
+        '''Set communication protocol parameters.'''
+        await self.confirmprot()
+        await self.setsys(si.O_PROT, (prot_cpc(self.cpc, prot),))
+
+    async def setcnmode(self, cn, mode='Control'):
+        '''Set control number and mode.'''
+        await self.setsys(si.O_MODE, cnmode_data(cn, mode))
+
+    async def setbatdate(self, date):
+        '''Set battery change date.'''
+        await self.setsys(si.O_BATDATE, (date.year % 100, date.month, date.day))
+
+## End of class AsyncSiAdmin ## ------------
+
 ## Constants ## ----------------------------
 ############### ----------------------------
+DAYS = ('Su', 'Mo', 'Tu', 'We', 'Th', 'Fr', 'Sa', '--')
 LOCAL  = 0
 REMOTE = 1
+BACKUP_STATE = os.path.join(si.STATE_DIR, 'backup.json')  # Last read backup pointers
+SURVEY_FIELDS = ('serial', 'cn', 'mode', 'fw', 'batdate', 'charge', 'voltage', 'temperature', 'time')
+SURVEY_POLL = 0.2       # Wait between polls while surveyed station is still in place
+DAEMON_SOCKET = os.path.join(os.environ.get('XDG_RUNTIME_DIR', si.STATE_DIR), 'siadmin.sock')
+UNTIL_CTRLC = ('listen', 'readout', 'survey')   # Commands running until Ctrl-C, main thread only
+CONFIG_PROT = ('extprot', 'autosend', 'handshk', 'password', 'punchread')
+CONFIG_KEYS = ('mode', 'batdate', 'time') + CONFIG_PROT
 
 ## Functions ## ----------------------------
 ############### ----------------------------
@@ -166,7 +335,10 @@ def Usage():
     usage = """
 
 Usage:
-    {script_name} [-h] [-tvql] -s <tty> command [params]
+    {script_name} [-h] [-vqlra] [-f <file>] [-p <policy>] [--stats[=<file>]] [--trace=<file>] [--upgrade] -s <tty> command [params]
+    {script_name} [-h] [-vqlr] [--replay=<file>] command [params]
+    {script_name} [-h] [-vqlr] [-p <policy>] [--stats[=<file>]] [--trace=<file>] -s <tty> --daemon[=<socket>]
+    {script_name} [-h] [-vq] --client[=<socket>] command [params]
 
 Setup SI station
 
@@ -178,6 +350,25 @@ Parameters:
     -r  ... setup remote SI station [default]
     -f <file>  ... log messages to <file>
     -s <tty>   ... serial port to use [first autodetected]
+    -a  ... fleet mode - run commands on all detected master stations in parallel
+            (listen, readout and survey are not available)
+            ({{port}} in command parameters is replaced by port name)
+    -p <policy> ... retry policy {{fixed, expo, jitter}} [expo]
+        fixed  = wait 1 s after each failure
+        expo   = immediate first retry, then exponential backoff
+        jitter = expo with randomized delays
+    --stats[=<file>] ... write per command statistics (latency, retries, bytes)
+            as JSON to <file> [stderr]
+    --trace=<file>  ... append binary trace of port traffic to <file> as new session
+            (in fleet mode {{port}} in <file> is replaced by port name)
+    --replay=<file> ... run commands against traffic recorded in trace <file>
+            (last session, same command list and options as recorded), without station
+    --upgrade ... raise station connected at 4800 Bd to 38400 Bd for bulk transfers
+            (backup, card readout), original speed is restored after
+    --daemon[=<socket>] ... keep station open and run commands sent by clients
+            on Unix <socket> until Ctrl-C [{daemon_socket}]
+            (listen, readout and survey are not available)
+    --client[=<socket>] ... send commands to daemon at <socket> and print its output
 
 Commands:
     off       ... turn off
@@ -198,14 +389,529 @@ Commands:
         as = autosend {{0,1}}
 
     wtime     ... write computer localtime to the station
+    stime     ... write computer localtime compensated for transit time,
+                  print remaining offset
+
+    rbackup <file>        ... read backup memory (punches) to <file>, raw or exported
+            by extension of <file>: .csv, .jsonl, .xml (IOF XML 3.0 ResultList)
+    sbackup <file>        ... append backup records new since last sync to <file>
+
+    listen    ... print punches and card events sent by station (autosend) until Ctrl-C
+    readout [file]        ... read cards inserted in readout station until Ctrl-C
+            [and export them to file .csv, .jsonl, .xml (IOF XML 3.0 ResultList)]
+    apply <file>          ... make station match config <file> (JSON, TOML if <file>
+            ends with .toml), only differing system data is written and verified:
+            {{"default": {{<settings>}}, "stations": {{"<cn>": {{<settings>}}}}}}
+            settings = mode, extprot, autosend, handshk, password, punchread (bool),
+                       batdate (yyyy-mm-dd), time (true = sync time,
+                       <seconds> = sync if station time is off by more)
+    survey <file>         ... append battery state of each station placed on master
+            to <file> (CSV, JSONL if <file> ends with .jsonl) until Ctrl-C,
+            stations already in <file> are skipped (needs remote mode)
 
 EOF
 """
-    print(usage.format(script_name = sys.argv[0]))
+    print(usage.format(script_name = sys.argv[0], daemon_socket = DAEMON_SOCKET))
     return
 
 ## Usage end ## ----------------------------
 
+## Command plan ## -------------------------
+# Commands answered from system data snapshot and commands writing system data
+SYS_READS = ('rcn', 'rfw', 'rbat', 'sbackup')
+SYS_WRITES = ('wcn', 'wprot', 'wbatdate')
+COMMANDS = ('off', 'beep', 'rtime', 'wtime', 'stime', 'rprot', 'rcn', 'rbat', 'rfw', 'rbackup', 'sbackup', 'listen', 'readout', 'survey', 'apply') + SYS_WRITES
+MERGE_GAP = 2           # Max. gap between writes filled from snapshot to merge them
+SETTLE_MODE = 0.1       # Station reconfigures after mode change
+
+def parse_commands(argn):
+    '''Split command list to (command, parameter) and check parameters
+       before anything is sent to the station.'''
+    cmds = []
+    argn = list(argn)
+    while len(argn) > 0:
+        cmd = argn.pop(0)
+        par = None
+        if cmd not in COMMANDS:
+            logging.warning("Unknown command: {}".format(cmd))
+            continue
+        if cmd == 'beep':
+            if len(argn) > 0 and argn[0].isdigit():
+                par = int(argn.pop(0))
+            else:
+                par = 1
+        elif cmd == 'readout':
+            if len(argn) > 0 and os.path.splitext(argn[0])[1].lower() in siexport.FORMATS:
+                par = argn.pop(0)
+        elif cmd in SYS_WRITES or cmd in ('rbackup', 'sbackup', 'survey', 'apply'):
+            if len(argn) == 0:
+                raise si.SiException("Missing parameter of command {}.".format(cmd))
+            par = argn.pop(0)
+            if cmd == 'wcn':
+                par = cnmode_data(*par.split(',', 1))
+            elif cmd == 'wprot':
+                ep,au = par.split(',', 1)
+                par = {'extprot': bool(int(ep)), 'autosend': bool(int(au))}
+            elif cmd == 'wbatdate':
+                d,m,y = par.split('.', 2)
+                par = datetime.date(int(y), int(m), int (d))
+            elif cmd == 'apply':
+                par = load_config(par)
+        cmds.append((cmd, par))
+    return cmds
+
+def compile_plan(cmds):
+    '''Make plan from parsed commands. Steps are (kind, command, parameter):
+       'read'  ... read whole system data snapshot once, at start,
+       'write' ... adjacent system data writes (list of commands) merged,
+       'cmd'   ... single command.'''
+    plan = []
+    writes = sum(1 for cmd, par in cmds if cmd in SYS_WRITES)
+    if writes > 1 or any(cmd in SYS_READS for cmd, par in cmds):
+        plan.append(('read', None, None))
+    group = None
+    for cmd, par in cmds:
+        if cmd in SYS_WRITES:
+            if group is None:
+                group = []
+                plan.append(('write', None, group))
+            group.append((cmd, par))
+        else:
+            group = None
+            plan.append(('cmd', cmd, par))
+    return plan
+
+def merge_writes(data, sysdata, gap=MERGE_GAP):
+    '''Merge written bytes ({offset: value}) to runs [(offset, bytes)].
+       Gaps up to gap bytes are filled with valid snapshot data.'''
+    runs = []
+    for offset in sorted(data):
+        if runs:
+            start, run = runs[-1]
+            end = start + len(run)
+            if offset - end <= gap and (offset == end or sysdata.missing(end, offset - end) is None):
+                run.extend(sysdata.get(end, offset - end))
+                run.append(data[offset])
+                continue
+        runs.append((offset, bytearray((data[offset],))))
+    return runs
+
+def write_group(siadm, group):
+    '''Send adjacent system data writes in as few C_SETDATA as possible.'''
+    data = {}
+    for cmd, par in group:
+        if cmd == 'wcn':
+            offset, values = si.O_MODE, par
+        elif cmd == 'wprot':
+            siadm.confirmprot()
+            offset, values = si.O_PROT, (prot_cpc(siadm.cpc, par),)
+        elif cmd == 'wbatdate':
+            offset, values = si.O_BATDATE, (par.year % 100, par.month, par.day)
+        for i, value in enumerate(values):
+            data[offset + i] = value
+    for offset, run in merge_writes(data, siadm.sysdata):
+        siadm.setsys(offset, run)
+    return si.O_MODE in data
+
+## Run commands ## -------------------------
+def run_command(siadm, cmd, par, out):
+    '''Run single command on station.'''
+    if cmd == 'off':
+        siadm.off()
+    elif cmd == 'beep':
+        siadm.beep(par)
+    elif cmd == 'rtime':
+        t = siadm.getime()
+        print('Station datetime: ', t.strftime('%d.%m.%Y %H:%M:%S'), file=out)
+    elif cmd == 'wtime':
+        siadm.setime()
+    elif cmd == 'stime':
+        offset = siadm.synctime()
+        print('Station time offset: {:+.1f} ms'.format(offset * 1000), file=out)
+    elif cmd == 'rprot':
+        siadm.confirmprot()
+        print("""Station protocol  CPC: 0x{:02x}
+    Extended protocol: {}
+    Autosend:          {}
+    Handshake:         {}
+    Password:          {}
+    Read after punch:  {}""".format(siadm.cpc, siadm.extprot, siadm.autosend, siadm.handshk, siadm.password, siadm.punchread), file=out)
+    elif cmd == 'rcn':
+        mode, cn = siadm.getmodecn()
+        try:
+            modestr = si.MODES[mode]
+        except IndexError:
+            modestr = 'Undef'
+        if modestr == 'Undef':
+            modestr += " ({})".format(mode)
+        print("Station number: {}".format(cn), file=out)
+        print("Station mode:   {}".format(modestr), file=out)
+    elif cmd == 'rbat':
+        bdate, bperc, bvolt, btemp = siadm.getbatall()
+        print("""Battery state:
+    Charge:      {} %
+    Voltage:     {:2.1f} V
+    Temperature: {:2.1f} °C
+    Change date: {}""".format(bperc, bvolt, btemp, bdate.strftime('%d.%m.%Y')), file=out)
+    elif cmd == 'rfw':
+        fw = siadm.getfwversion()
+        print("Firmware version: {}".format(fw.decode()), file=out)
+    elif cmd == 'rbackup':
+        if os.path.splitext(par)[1].lower() in siexport.FORMATS:
+            mode, cn = siadm.getmodecn()
+            with tempfile.TemporaryFile() as raw:
+                end = siadm.getbackup(raw)
+                raw.seek(0)
+                punches = siexport.backup_punches(raw, cn)
+                with open(par, 'w', newline='') as wfile:
+                    siexport.write(siexport.export(punches, par, classname='CN {}'.format(cn)), wfile)
+        else:
+            with open(par, 'wb') as wfile:
+                end = siadm.getbackup(wfile)
+        records = (end - si.BACKUP_START) // si.BACKUP_REC
+        print("Backup memory: {} records written to {}".format(records, par), file=out)
+    elif cmd == 'sbackup':
+        state = si.StateFile(BACKUP_STATE)
+        with open(par, 'ab') as wfile:
+            start, end = siadm.syncbackup(wfile, state)
+        records = (end - start) // si.BACKUP_REC
+        print("Backup memory: {} new records appended to {}".format(records, par), file=out)
+    elif cmd == 'listen':
+        try:
+            for event in siadm.listen():
+                print(format_event(event), file=out, flush=True)
+        except KeyboardInterrupt:
+            pass
+        if siadm.dropped:
+            logging.warning("{} events dropped, consumer too slow.".format(siadm.dropped))
+    elif cmd == 'readout':
+        cards = readout_cards(siadm, out)
+        if par is None:
+            for card in cards:
+                pass
+        else:
+            punches = (p for card in cards for p in siexport.card_punches(card))
+            with open(par, 'w', newline='') as wfile:
+                siexport.write(siexport.export(punches, par, classname='Readout'), wfile, flush=True)
+    elif cmd == 'survey':
+        count = run_survey(siadm, par, out)
+        print("Survey: {} stations appended to {}".format(count, par), file=out)
+    elif cmd == 'apply':
+        apply_config(siadm, par, out)
+
+def readout_cards(siadm, out):
+    '''Generator of cards inserted in readout station, each printed to out, until Ctrl-C.'''
+    try:
+        while True:
+            events = siadm.listen()
+            try:
+                event = next(e for e in events if e.kind == 'insert')
+            finally:
+                events.close()
+            card = siadm.readcard(event.cardtype)
+            print(format_card(card), file=out, flush=True)
+            yield card
+    except KeyboardInterrupt:
+        pass
+
+def run_plan(siadm, plan, out=None):
+    '''Run compiled plan on station.'''
+    if out is None: out = sys.stdout
+    for n, (kind, cmd, par) in enumerate(plan):
+        if kind == 'read':
+            siadm.readsys()
+        elif kind == 'write':
+            if write_group(siadm, par) and n + 1 < len(plan):
+                time.sleep(SETTLE_MODE)
+        else:
+            run_command(siadm, cmd, par, out)
+
+def run_commands(siadm, argn, out=None):
+    '''Run command list (CLI commands with parameters) on station.'''
+    run_plan(siadm, compile_plan(parse_commands(argn)), out)
+
+## Survey ## --------------------------------
+def survey_row(siadm):
+    '''Survey record of station, answered from system data snapshot.'''
+    mode, cn = siadm.getmodecn()
+    bdate, bperc, bvolt, btemp = siadm.getbatall()
+    return {'serial': siadm.getserial(), 'cn': cn,
+            'mode': si.MODES[mode] if mode < len(si.MODES) else 'Undef',
+            'fw': siadm.getfwversion().decode(errors='replace'), 'batdate': bdate.isoformat(),
+            'charge': bperc, 'voltage': round(bvolt, 2), 'temperature': round(btemp, 1),
+            'time': datetime.datetime.now().isoformat(timespec='seconds')}
+
+def surveyed(path, jsonl):
+    '''Serial numbers of stations already in survey file. CSV file in other
+       format (e.g. older batstate.py output) is refused.'''
+    if not os.path.exists(path): return set()
+    with open(path, newline='') as rfile:
+        if not jsonl:
+            header = rfile.readline()
+            if header and next(csv.reader([header]), []) != list(SURVEY_FIELDS):
+                raise si.SiException("File {} is not a survey file (header {}), use another file.".format(
+                    path, ','.join(SURVEY_FIELDS)))
+            rfile.seek(0)
+        rows = (json.loads(line) for line in rfile if line.strip()) if jsonl else csv.DictReader(rfile)
+        return {int(row['serial']) for row in rows if str(row.get('serial', '')).isdigit()}
+
+def run_survey(siadm, path, out, poll=SURVEY_POLL):
+    '''Poll remote station placed on master, append one row for each new station
+       to path (CSV, JSONL if path ends with .jsonl) until Ctrl-C.
+       Each station is read by one C_GETDATA of whole system data and confirmed
+       by beep. Returns number of stations surveyed.'''
+    jsonl = path.endswith('.jsonl')
+    done = surveyed(path, jsonl)
+    count = 0
+    with open(path, 'a', newline='') as wfile:
+        writer = None if jsonl else csv.DictWriter(wfile, SURVEY_FIELDS)
+        if writer and wfile.tell() == 0:
+            writer.writeheader()
+        try:
+            while True:
+                siadm.sysdata.invalidate()
+                try:
+                    siadm.readsys(tries=1)
+                except si.SiException:
+                    continue                # No station in place (yet)
+                serial = siadm.sysdata.serial
+                if serial not in done:
+                    done.add(serial)
+                    try:
+                        row = survey_row(siadm)
+                    except (ValueError, ZeroDivisionError) as e:
+                        logging.warning("Station {}: bad battery data ({}).".format(serial, e))
+                        continue
+                    if jsonl:
+                        wfile.write(json.dumps(row) + '\n')
+                    else:
+                        writer.writerow(row)
+                    wfile.flush()
+                    count += 1
+                    print("{serial:>8} CN {cn:3} {mode:8} battery {charge:3} % {voltage:4.2f} V, changed {batdate}".format(**row),
+                          file=out, flush=True)
+                    try:
+                        siadm.beep()
+                    except si.SiException:
+                        pass                # Station removed too early
+                time.sleep(poll)
+        except KeyboardInterrupt:
+            pass
+    return count
+
+## Config ## --------------------------------
+def config_settings(settings):
+    '''Check settings of config file, return them converted.'''
+    settings = dict(settings)
+    for key, value in settings.items():
+        if key not in CONFIG_KEYS:
+            raise si.SiException("Unknown config setting: {}".format(key))
+        if key in CONFIG_PROT and not isinstance(value, bool):
+            raise si.SiException("Config setting {} must be true or false.".format(key))
+    if 'mode' in settings and settings['mode'] not in si.MODES:
+        raise si.SiException("Unknown station mode: {}".format(settings['mode']))
+    if isinstance(settings.get('batdate'), str):
+        settings['batdate'] = datetime.date.fromisoformat(settings['batdate'])
+    elif 'batdate' in settings and not isinstance(settings['batdate'], datetime.date):
+        raise si.SiException("Config setting batdate must be a date.")
+    if not isinstance(settings.get('time', False), (bool, int, float)):
+        raise si.SiException("Config setting time must be true, false or seconds.")
+    return settings
+
+def load_config(path):
+    '''Load and check station config (JSON, TOML if path ends with .toml).
+       Returns (default settings, {cn: settings}).'''
+    try:
+        if path.endswith('.toml'):
+            if tomllib is None:
+                raise si.SiException("TOML config needs Python 3.11 or newer.")
+            with open(path, 'rb') as rfile:
+                config = tomllib.load(rfile)
+        else:
+            with open(path) as rfile:
+                config = json.load(rfile)
+        default = config_settings(config.get('default', {}))
+        stations = {cnmode_data(cn)[1]: config_settings(settings)
+                    for cn, settings in config.get('stations', {}).items()}
+    except (OSError, ValueError) as e:
+        raise si.SiException("Cannot load config {}: {}".format(path, e))
+    return default, stations
+
+def config_writes(settings, sysdata):
+    '''System data bytes {offset: value} differing from snapshot.'''
+    data = {}
+    if 'mode' in settings:
+        data[si.O_MODE] = si.MODES.index(settings['mode'])
+    prot = {key: settings[key] for key in CONFIG_PROT if key in settings}
+    if prot:
+        data[si.O_PROT] = prot_cpc(sysdata.cpc, prot)
+    if 'batdate' in settings:
+        d = settings['batdate']
+        data.update(zip(range(si.O_BATDATE, si.O_BATDATE + 3), (d.year % 100, d.month, d.day)))
+    return {offset: value for offset, value in data.items() if sysdata.get(offset, 1)[0] != value}
+
+def apply_config(siadm, config, out):
+    '''Make station match config (from load_config) chosen by its control number.
+       Only system data bytes differing from the snapshot are written (merged
+       C_SETDATA), then they are read back in one C_GETDATA. Time is synced
+       according to time setting. Returns list of changed settings.'''
+    default, stations = config
+    siadm.readsys()
+    cn = siadm.sysdata.cn
+    if cn not in stations and not default:
+        raise si.SiException("No config for control number {}.".format(cn))
+    settings = dict(default, **stations.get(cn, {}))
+    data = config_writes(settings, siadm.sysdata)
+    changed = [name for name, offsets in (('mode', (si.O_MODE,)), ('protocol', (si.O_PROT,)),
+                                          ('batdate', range(si.O_BATDATE, si.O_BATDATE + 3)))
+               if any(offset in data for offset in offsets)]
+    if data:
+        for offset, run in merge_writes(data, siadm.sysdata):
+            siadm.setsys(offset, run)
+        if si.O_MODE in data:
+            time.sleep(SETTLE_MODE)
+        low = min(data)
+        check = siadm.readsys(low, max(data) - low + 1, whole=False)
+        for offset, value in data.items():
+            if check[offset - low] != value:
+                raise si.SiException("Verify failed at 0x{:02x}: 0x{:02x} instead of 0x{:02x}.".format(
+                    offset, check[offset - low], value))
+    result = "written {}".format(', '.join(changed)) if changed else "up to date"
+
+    policy = settings.get('time', False)
+    if policy is not False:
+        if policy is True or abs(siadm.timeprobe()[0]) > policy:
+            changed.append('time')
+            result += ", time synced, offset {:+.1f} ms".format(siadm.synctime() * 1000)
+        else:
+            result += ", time OK"
+    print("CN {}: {}".format(cn, result), file=out)
+    return changed
+
+## Daemon ## --------------------------------
+def daemon_request(siadm, request):
+    '''Run request of client {"args": [command list], "cwd": directory}.
+       Returns response {"ok": bool, "output": text, "error": text}.'''
+    out = io.StringIO()
+    try:
+        cmds = parse_commands(request['args'])
+        refused = [cmd for cmd, par in cmds if cmd in UNTIL_CTRLC]
+        if refused:
+            raise si.SiException("Command {} not available in daemon.".format(refused[0]))
+        os.chdir(request.get('cwd', '/'))  # File parameters are relative to client
+        if siadm.remote:                    # Remote station may have been replaced
+            siadm.switched(si.MODE_REMOTE)
+        else:
+            siadm.sysdata.invalidate()
+        run_plan(siadm, compile_plan(cmds), out)
+    except (si.SiException, serial.SerialException, OSError, ValueError, IndexError, KeyError, TypeError) as e:
+        logging.warning("Request failed: {}: {}".format(type(e).__name__, e))
+        return {'ok': False, 'output': out.getvalue(), 'error': "{}: {}".format(type(e).__name__, e)}
+    return {'ok': True, 'output': out.getvalue(), 'error': None}
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+    '''Client connection: one JSON request per line, one JSON response line to each.'''
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                response = {'ok': False, 'output': '', 'error': "Bad request: {}".format(e)}
+            else:
+                response = daemon_request(self.server.siadm, request)
+            self.wfile.write((json.dumps(response) + '\n').encode())
+
+def daemon_socket(path=DAEMON_SOCKET):
+    '''Check that no daemon runs at socket path, remove stale socket.
+       Returns absolute path.'''
+    path = os.path.abspath(path)
+    if os.path.exists(path):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            if sock.connect_ex(path) == 0:
+                raise si.SiException("Daemon already running at {}.".format(path))
+        os.unlink(path)                     # Stale socket of killed daemon
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+def run_daemon(siadm, path=DAEMON_SOCKET):
+    '''Serve client requests on Unix socket, one at a time, until Ctrl-C or SIGTERM.'''
+    path = daemon_socket(path)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    with socketserver.UnixStreamServer(path, DaemonHandler) as server:
+        server.siadm = siadm
+        try:
+            os.chmod(path, 0o600)
+            logging.info("Daemon listening at {}".format(path))
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(path)
+
+def run_client(argn, path=DAEMON_SOCKET, out=None):
+    '''Send command list to daemon, print its output. Returns 0 for success, 1 for failure.'''
+    if out is None: out = sys.stdout
+    request = {'args': list(argn), 'cwd': os.getcwd()}
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(path)
+            sock.sendall((json.dumps(request) + '\n').encode())
+            with sock.makefile('rb') as rfile:
+                response = json.loads(rfile.readline())
+    except (OSError, ValueError) as e:
+        logging.error("No reply from daemon at {}: {}".format(path, e))
+        return 1
+    print(response['output'], end='', file=out)
+    if not response['ok']:
+        logging.error(response['error'])
+        return 1
+    return 0
+
+## Fleet ## ---------------------------------
+def run_fleet(ports, argn, target=REMOTE, retry=None, stats=None, tracefile=None, upgrade=False):
+    '''Run the same command list on all ports in parallel.
+       "{port}" in command parameters and trace file name is replaced by port name.
+       Statistics of each port are collected to stats dict (port: Stats) if given.
+       Prints output, result and time of each port, returns number of failed ports.'''
+    def worker(port):
+        out = io.StringIO()
+        start = time.monotonic()
+        name = os.path.basename(port)
+        trace = si.WireTrace(tracefile.replace('{port}', name)) if tracefile else None
+        try:
+            siadm = SiAdmin(port, retry=retry, trace=trace, cache=None if trace else si.PORT_CACHE, upgrade=upgrade,
+                            stats=stats.setdefault(port, si.Stats()) if stats is not None else None)
+            try:
+                if target == REMOTE:
+                    siadm.setremote()
+                run_commands(siadm, [a.replace('{port}', name) for a in argn], out)
+            finally:
+                siadm.close()
+        except (si.SiException, serial.SerialException, OSError, ValueError, IndexError) as e:
+            return port, False, "{}: {}".format(type(e).__name__, e), time.monotonic() - start, out.getvalue()
+        finally:
+            if trace: trace.close()
+        return port, True, "OK", time.monotonic() - start, out.getvalue()
+
+    failed = 0
+    start = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(ports)) as pool:
+        for port, ok, result, elapsed, output in pool.map(worker, ports):
+            print("=== {}: {} ({:.2f} s)".format(port, result, elapsed))
+            if output: print(output, end='')
+            if not ok: failed += 1
+    print("=== {} ports, {} failed, total {:.2f} s".format(len(ports), failed, time.monotonic() - start))
+    return failed
+
+def write_stats(statsfile, data):
+    '''Write statistics as JSON to file ('-' is stderr).'''
+    text = json.dumps(data, indent=2)
+    if statsfile == '-':
+        print(text, file=sys.stderr)
+    else:
+        with open(statsfile, 'w') as f:
+            f.write(text + '\n')
+
 ## Main ## ---------------------------
 ######################################
 def main():
@@ -215,6 +921,14 @@ def main():
     target = REMOTE
     logfile = None
     port = None
+    policy = si.RETRY_DEFAULT
+    fleet = False
+    statsfile = None
+    tracefile = None
+    replayfile = None
+    daemonsock = None
+    clientsock = None
+    upgrade = False
 
 ## Getparam ## -----------------------------
     argn = []
@@ -222,7 +936,23 @@ def main():
     i = 1
     try:
         while(i < len(args)):
-            if(args[i][0] == '-'):
+            if args[i].startswith('--'):
+                name, eq, value = args[i][2:].partition('=')
+                if name == 'stats':
+                    statsfile = value or '-'
+                elif name == 'trace' and value:
+                    tracefile = value
+                elif name == 'replay' and value:
+                    replayfile = value
+                elif name == 'upgrade':
+                    upgrade = True
+                elif name == 'daemon':
+                    daemonsock = value or DAEMON_SOCKET
+                elif name == 'client':
+                    clientsock = value or DAEMON_SOCKET
+                else:
+                    raise IndexError
+            elif(args[i][0] == '-'):
                 for j in args[i][1:]:
                     if j == 'h':
                         Usage()
@@ -241,6 +971,11 @@ def main():
                     elif j == 's':
                         i += 1
                         port = args[i]
+                    elif j == 'p':
+                        i += 1
+                        policy = args[i]
+                    elif j == 'a':
+                        fleet = True
             else:
                 argn.append(args[i])
             i += 1
@@ -255,6 +990,61 @@ def main():
         logcfg['filename'] = logfile
     logging.basicConfig(**logcfg)
 
+    if clientsock:
+        return run_client(argn, clientsock)
+
+    if policy not in si.RETRY_POLICIES:
+        logging.error("Unknown retry policy: {}".format(policy))
+        return 1
+
+    if fleet and daemonsock:
+        logging.error("Daemon runs on one station, fleet mode is not supported.")
+        return 1
+
+    if fleet:
+        ports = si.station_detect() if not port else [port]
+        if len(ports) == 0:
+            logging.error("No master station detected.")
+            return 1
+        try:        # Check commands before anything is sent
+            for p in ports:
+                cmds = parse_commands([a.replace('{port}', os.path.basename(p)) for a in argn])
+                refused = [cmd for cmd, par in cmds if cmd in UNTIL_CTRLC]
+                if refused:
+                    raise si.SiException("Command {} not available in fleet mode.".format(refused[0]))
+        except (si.SiException, ValueError) as e:
+            logging.error(e)
+            return 1
+        stats = {} if statsfile else None
+        try:
+            return run_fleet(ports, argn, target, si.RETRY_POLICIES[policy], stats, tracefile, upgrade)
+        finally:
+            if statsfile:
+                write_stats(statsfile, {port: s.as_dict() for port, s in stats.items()})
+
+    try:            # Check commands before anything is sent
+        plan = compile_plan(parse_commands(argn))
+    except (si.SiException, ValueError) as e:
+        logging.error(e)
+        return 1
+
+    if daemonsock:
+        try:
+            daemon_socket(daemonsock)       # Before the port is touched
+        except si.SiException as e:
+            logging.error(e)
+            return 1
+
+    options = {'retry': si.RETRY_POLICIES[policy], 'upgrade': upgrade}
+    if replayfile:
+        # Replay at full speed: no port cache, no waiting between retries
+        port = 'replay'
+        options['retry'] = copy.copy(options['retry'])
+        options['retry'].delay = options['retry'].maxdelay = 0
+        options.update(cache=None, transport=si.ReplaySerial(replayfile))
+    elif tracefile:
+        options.update(cache=None, trace=si.WireTrace(tracefile))     # Replayable without cache
+
     if not port:
         ports = si.station_detect()
         if len(ports) == 0:
@@ -264,70 +1054,26 @@ def main():
             port = ports[0]
             logging.debug("Detected master station at: {}".format(port))
 
-    # Only first detected SI station is used
-    siadm = SiAdmin(port)
-
-    if target == REMOTE:
-        siadm.setremote()
-    # Local is set during initialization
+    # Only first detected SI station is used (see -a)
+    stats = si.Stats() if statsfile else None
+    try:
+        siadm = SiAdmin(port, stats=stats, **options)
 
-    while len(argn) > 0:
-        cmd = argn.pop(0)
-        if cmd == 'off':
-            siadm.off()
-        elif cmd == 'beep':
-            if len(argn) > 0 and argn[0].isdigit():
-                times = int(argn.pop(0))
-            else:
-                times = 1
-            siadm.beep(times)
-        elif cmd == 'rtime':
-            t = siadm.getime()
-            print('Station datetime: ', t.strftime('%d.%m.%Y %H:%M:%S'))
-        elif cmd == 'wtime':
-            siadm.setime()
-        elif cmd == 'rprot':
-            print("""Station protocol  CPC: 0x{:02x}
-    Extended protocol: {}
-    Autosend:          {}
-    Handshake:         {}
-    Password:          {}
-    Read after punch:  {}""".format(siadm.cpc, siadm.extprot, siadm.autosend, siadm.handshk, siadm.password, siadm.punchread))
-        elif cmd == 'rcn':
-            mode, cn = siadm.getmodecn()
-            try:
-                modestr = si.MODES[mode]
-            except IndexError:
-                modestr = 'Undef'
-            if modestr == 'Undef':
-                modestr += " ({})".format(mode)
-            print("Station number: {}".format(cn))
-            print("Station mode:   {}".format(modestr))
-        elif cmd == 'rbat':
-            bdate, bperc, bvolt, btemp = siadm.getbatall()
-            print("""Battery state:
-    Charge:      {} %
-    Voltage:     {:2.1f} V
-    Temperature: {:2.1f} °C
-    Change date: {}""".format(bperc, bvolt, btemp, bdate.strftime('%d.%m.%Y')))
-        elif cmd == 'wprot':
-            ep,au = argn.pop(0).split(',', 1)
-            siadm.setprot({'extprot': bool(int(ep)), 'autosend': bool(int(au))})
-        elif cmd == 'wcn':
-            numode = argn.pop(0).split(',', 1)
-            siadm.setcnmode(*numode)
-        elif cmd == 'rfw':
-            fw = siadm.getfwversion()
-            print("Firmware version: {}".format(fw.decode()))
-        elif cmd == 'wbatdate':
-            y,m,d = argn(pop(0).split(',', 1))
-            bd = datetime.date(int(y), int(m), int (d))
-            siadm.setbatdate(bd)
+        if target == REMOTE:
+            siadm.setremote()
+        # Local is set during initialization
 
-        if len(argn) > 0: time.sleep(0.5)
+        run_plan(siadm, plan)
+        if daemonsock:
+            run_daemon(siadm, daemonsock)
+    finally:
+        if statsfile:
+            write_stats(statsfile, stats.as_dict())
+        if 'trace' in options:
+            options['trace'].close()
 ###
 ## Main run ## -----------------------
 ######################################
 if __name__ == '__main__': 
-    main()
+    sys.exit(main())
 
@@ -0,0 +1,219 @@
+#!/usr/bin/python3
+#
+################################################
+# Streaming export of SPORTident punches and card readouts
+# to CSV, JSON Lines and IOF XML 3.0 (ResultList)
+#
+# Author:  Martin Horak
+# Version: 1.1
+# Date:    16. 10. 2026
+#
+################################################
+
+import sportident as si
+import os, sys, io, csv, json, itertools, logging
+from collections import namedtuple
+from datetime import datetime, date, time, timedelta
+from xml.sax.saxutils import escape
+
+FORMATS = ('.csv', '.jsonl', '.xml')    # Export formats by file extension
+EXPORT_CHUNK = 4096 * si.BACKUP_REC     # Bytes of backup dump read at once
+IOF_NS = 'http://www.orienteering.org/datastandard/3.0'
+
+ExportPunch = namedtuple('ExportPunch', 'card cn kind time')
+ExportPunch.__doc__ = '''Exported punch, kind is punch, start, finish or check,
+time is datetime (None if missing).'''
+COLUMNS = ExportPunch._fields
+
+## Sources ## -----------------------------
+############# -----------------------------
+def backup_punch(d, cn=0):
+    '''ExportPunch from 8 byte backup record (see si.BACKUP_REC), None for empty or bad record.'''
+    date1 = (d[3] << 8) + d[4]
+    t = (d[5] << 8) + d[6]
+    if t == si.SI5_NULL or t >= 43200: return None
+    try:
+        day = datetime(2000 + (date1 >> 10), (date1 >> 6) & 0x0F, (date1 >> 1) & 0x1F)
+    except ValueError:
+        return None
+    secs = t + (date1 & 0x01) * 43200 + d[7] / 256
+    return ExportPunch(si.card_number(0, d[0], d[1], d[2])[0], cn, 'punch', day + timedelta(seconds=secs))
+
+def backup_punches(rfile, cn=0, chunk=EXPORT_CHUNK):
+    '''Generator of ExportPunch from raw backup dump (as written by rbackup),
+       read chunk bytes at a time. Empty and bad records are skipped.'''
+    rest = b''
+    while True:
+        data = rfile.read(chunk)
+        if not data: break
+        data = rest + data
+        end = len(data) - len(data) % si.BACKUP_REC
+        for o in range(0, end, si.BACKUP_REC):
+            punch = backup_punch(data[o:o+si.BACKUP_REC], cn)
+            if punch: yield punch
+        rest = data[end:]
+    if rest:
+        logging.warning("Incomplete backup record at the end ({} bytes) ignored.".format(len(rest)))
+
+def card_punches(card, day=None):
+    '''Generator of ExportPunch from card readout (si.Card), times on day (default today).'''
+    base = datetime.combine(day or date.today(), time())
+    def punch(kind, p):
+        t = None if p.time is None else base + timedelta(seconds=p.time)
+        return ExportPunch(card.card, p.cn, kind, t)
+    if card.check: yield punch('check', card.check)
+    if card.start: yield punch('start', card.start)
+    for p in card.punches:
+        yield punch('punch', p)
+    if card.finish: yield punch('finish', card.finish)
+
+def by_card(punches):
+    '''Group consecutive punches of the same card: generator of (card, [ExportPunch]).'''
+    for card, group in itertools.groupby(punches, key=lambda p: p.card):
+        yield card, list(group)
+
+## Formats ## -----------------------------
+############# -----------------------------
+def isotime(t):
+    return t.isoformat(timespec='milliseconds') if t else None
+
+def to_csv(punches):
+    '''Generator of CSV text lines (with header).'''
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    def line(row):
+        writer.writerow(row)
+        text = buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+        return text
+    yield line(COLUMNS)
+    for p in punches:
+        yield line((p.card, p.cn, p.kind, isotime(p.time) or ''))
+
+def to_jsonl(punches):
+    '''Generator of JSON Lines.'''
+    for p in punches:
+        yield json.dumps({'card': p.card, 'cn': p.cn, 'kind': p.kind, 'time': isotime(p.time)}) + '\n'
+
+def iof_result(card, punches):
+    '''IOF XML 3.0 PersonResult of one card. Split times are relative to start
+       punch, or to the first punch if there is none (backup of one station).'''
+    start = next((p.time for p in punches if p.kind == 'start'), None)
+    finish = next((p.time for p in punches if p.kind == 'finish'), None)
+    splits = [p for p in punches if p.kind == 'punch']
+    if start is None:
+        start = next((p.time for p in splits if p.time), None)
+    lines = ['  <PersonResult>',
+             '   <Person><Name><Family></Family><Given></Given></Name></Person>',
+             '   <Result>']
+    if start: lines.append('    <StartTime>{}</StartTime>'.format(isotime(start)))
+    if finish: lines.append('    <FinishTime>{}</FinishTime>'.format(isotime(finish)))
+    if start and finish: lines.append('    <Time>{:.3f}</Time>'.format((finish - start).total_seconds()))
+    lines.append('    <Status>{}</Status>'.format('Finished' if finish else 'DidNotFinish'))
+    for p in splits:
+        if p.time and start:
+            lines.append('    <SplitTime><ControlCode>{}</ControlCode><Time>{:.3f}</Time></SplitTime>'.format(
+                p.cn, (p.time - start).total_seconds()))
+        else:
+            lines.append('    <SplitTime status="Missing"><ControlCode>{}</ControlCode></SplitTime>'.format(p.cn))
+    lines.append('    <ControlCard punchingSystem="SI">{}</ControlCard>'.format(card))
+    lines += ['   </Result>', '  </PersonResult>', '']
+    return '\n'.join(lines)
+
+def to_iof(punches, event='SPORTident export', classname='SI'):
+    '''Generator of IOF XML 3.0 ResultList, one PersonResult for each run
+       of consecutive punches of the same card.'''
+    yield ('<?xml version="1.0" encoding="UTF-8"?>\n'
+           '<ResultList xmlns="{}" iofVersion="3.0" createTime="{}" creator="siadmin" status="Snapshot">\n'
+           ' <Event><Name>{}</Name></Event>\n'
+           ' <ClassResult>\n'
+           '  <Class><Name>{}</Name></Class>\n').format(
+               IOF_NS, datetime.now().astimezone().isoformat(timespec='seconds'), escape(event), escape(classname))
+    for card, group in by_card(punches):
+        yield iof_result(card, group)
+    yield ' </ClassResult>\n</ResultList>\n'
+
+def export(punches, path, **iof):
+    '''Generator of exported text, format by path extension (see FORMATS).
+       Keyword arguments are passed to to_iof.'''
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.csv': return to_csv(punches)
+    if ext == '.jsonl': return to_jsonl(punches)
+    if ext == '.xml': return to_iof(punches, **iof)
+    raise si.SiException("Unknown export format: {} (use {}).".format(ext, ', '.join(FORMATS)))
+
+def write(chunks, wfile, flush=False):
+    '''Write text chunks to file as they come (flush each with flush), returns number of chunks.'''
+    count = 0
+    for text in chunks:
+        wfile.write(text)
+        if flush: wfile.flush()
+        count += 1
+    return count
+
+## Usage ## -------------------------------
+########### -------------------------------
+def Usage():
+    'Usage help'
+
+    usage = """
+
+Usage:
+    {script_name} [-h] [-c <cn>] [-e <event>] <dump> <file>
+
+Export raw backup memory dump (siadmin.py rbackup <dump>) to <file>.
+Format by extension of <file>: {formats}
+
+Parameters:
+    -h  ... help - this help
+    -c <cn>    ... control number of the station [0]
+    -e <event> ... event name in IOF XML
+
+EOF
+"""
+    print(usage.format(script_name = sys.argv[0], formats = ', '.join(FORMATS)))
+    return
+
+## Main ## --------------------------------
+########## --------------------------------
+def main():
+    '''Export backup dump'''
+    cn = 0
+    iof = {}
+    files = []
+
+    args = sys.argv
+    i = 1
+    try:
+        while(i < len(args)):
+            if(args[i][0] == '-'):
+                for j in args[i][1:]:
+                    if j == 'h':
+                        Usage()
+                        return
+                    elif j == 'c':
+                        i += 1
+                        cn = int(args[i])
+                    elif j == 'e':
+                        i += 1
+                        iof['event'] = args[i]
+            else:
+                files.append(args[i])
+            i += 1
+        dump, path = files
+    except (IndexError, ValueError):
+        print("Parameter read error.")
+        Usage()
+        return 1
+    if os.path.splitext(path)[1].lower() not in FORMATS:
+        print("Unknown export format: {}".format(path))
+        Usage()
+        return 1
+
+    logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.WARNING)
+    with open(dump, 'rb') as rfile, open(path, 'w', newline='') as wfile:
+        write(export(backup_punches(rfile, cn), path, classname='CN {}'.format(cn), **iof), wfile)
+
+if __name__ == '__main__':
+    sys.exit(main())
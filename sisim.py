@@ -0,0 +1,427 @@
+#!/usr/bin/python3
+#
+################################################
+# Simulated SPORTident station on pseudo-terminal
+#
+# Author:  Martin Horak
+# Version: 1.1
+# Date:    16. 10. 2026
+#
+################################################
+
+import sportident as si
+import os, sys, tty, termios, select, threading, time, random, logging
+from datetime import datetime, timedelta
+
+SPEEDS = {0: 4800, 1: 38400}        # C_SETSPEED parameter -> baudrate
+SERIES = {9: 1, 8: 2, 20: 4, 10: 15, 11: 15, 30: 15}   # Card type -> SI8+ card series
+CARD_SIZE = 8 * si.CARD_BLOCK       # Memory of SI6 and SI8+ cards
+
+## Data conversion ## ---------------------
+##################### ----------------------
+def mkframe(command, cn, data):
+    '''Reply frame of station cn.'''
+    body = bytearray((command, len(data) + 2, cn >> 8, cn & 0xff))
+    body.extend(data)
+    crcsum = si.crc(body)
+    return bytes((si.STX,)) + body + bytes((crcsum >> 8, crcsum & 0xff, si.ETX))
+
+def punchdata(t):
+    '''TD, TH, TL, TSS bytes of datetime t (as in C_PUNCH).'''
+    return tuple(si.timedata(t)[3:7])
+
+def card_bytes(number):
+    '''SI3..SI0 bytes of card number (inverse of card_number).'''
+    if number < 500000:         # SI5, series in SI2
+        low = number % 100000
+        return (0, number // 100000, low >> 8, low & 0xff)
+    return ((number >> 24) & 0xff, (number >> 16) & 0xff, (number >> 8) & 0xff, number & 0xff)
+
+def punch4_bytes(punch):
+    '''4 byte record PTD, CN, PTH, PTL of Punch, empty record for None.'''
+    if punch is None or punch.time is None:
+        return b'\xee' * 4
+    secs = int(punch.time)
+    td = ((punch.dow or 0) << 1) | (secs >= 43200) | ((punch.cn >> 8) << 6)
+    secs %= 43200
+    return bytes((td, punch.cn & 0xff, secs >> 8, secs & 0xff))
+
+def card_memory(card):
+    '''Card memory with data of si.Card (128 bytes for SI5, 8 blocks for others).'''
+    si3, si2, si1, si0 = card_bytes(card.card)
+    if card.cardtype == 5:
+        d = bytearray(si.CARD_BLOCK)
+        def t5(offset, punch):
+            t = si.SI5_NULL if punch is None or punch.time is None else int(punch.time) % 43200
+            d[offset:offset+2] = (t >> 8, t & 0xff)
+        d[4:7] = (si1, si0, si2)
+        d[0x17] = len(card.punches) + 1
+        t5(0x13, card.start)
+        t5(0x15, card.finish)
+        t5(0x19, card.check)
+        for i, punch in enumerate(card.punches[:36]):
+            if i < 30:
+                o = 0x21 + 3 * i + i // 5
+                d[o] = punch.cn
+                t5(o+1, punch)
+            else:
+                d[0x20 + (i - 30) * 0x10] = punch.cn
+        return bytes(d)
+    d = bytearray(b'\xee' * CARD_SIZE)
+    if card.cardtype == 6:
+        command = si.C_GETSI6
+        d[7] = 0xED
+        d[10:14] = (si3, si2, si1, si0)
+        d[0x12] = len(card.punches)
+        d[20:24] = punch4_bytes(card.finish)
+        d[24:28] = punch4_bytes(card.start)
+        d[28:32] = punch4_bytes(card.check)
+    else:
+        command = si.C_GETSI8
+        d[7] = 0xEA
+        d[8:12] = punch4_bytes(card.check)
+        d[12:16] = punch4_bytes(card.start)
+        d[16:20] = punch4_bytes(card.finish)
+        d[0x16] = len(card.punches)
+        d[24:28] = (SERIES.get(card.cardtype, 2), si2, si1, si0)
+    for addr, punch in zip(si.punch_addrs(command, d), card.punches):
+        d[addr:addr+4] = punch4_bytes(punch)
+    return bytes(d)
+
+## Virtual station ## ---------------------
+##################### ----------------------
+class SimStation():
+    '''Virtual SI station: system data, backup memory, clock and card in reader.'''
+    def __init__(self, cn=31, mode='Control', serial=500123, cpc=0x05, memsize=128):
+        self.sysdata = bytearray(b'\xff' * si.SYSDATA_SIZE)
+        self.sysdata[si.O_SERIAL:si.O_SERIAL+4] = serial.to_bytes(4, 'big')
+        self.sysdata[si.O_FWVER:si.O_FWVER+3] = b'656'
+        self.sysdata[si.O_MEMSIZE] = memsize
+        self.sysdata[si.O_BATDATE:si.O_BATDATE+3] = (20, 4, 18)
+        self.sysdata[si.O_BATCAP:si.O_BATCAP+4] = (1400 * 3600).to_bytes(4, 'big')    # mAs
+        self.sysdata[si.O_BATCONS:si.O_BATCONS+4] = (140 * 3600).to_bytes(4, 'big')
+        self.sysdata[si.O_BATVOLT:si.O_BATVOLT+2] = (360).to_bytes(2, 'big')           # 10 mV
+        self.sysdata[si.O_BATTEMP:si.O_BATTEMP+2] = (215).to_bytes(2, 'big')           # 0.1 °C
+        self.sysdata[si.O_MODE] = si.MODES.index(mode)
+        self.sysdata[si.O_CODE] = cn
+        self.sysdata[si.O_PROT] = cpc
+        self.mem = bytearray(b'\xff' * (memsize * 1024))
+        self.backptr = si.BACKUP_START
+        self.offset = timedelta()       # Station clock minus computer clock
+        self.card = None                # (read command, memory) of card in reader
+        self.beeps = 0
+
+    @property
+    def cn(self):
+        return self.sysdata[si.O_CODE]
+
+    @property
+    def cpc(self):
+        return self.sysdata[si.O_PROT]
+
+    @property
+    def backptr(self):
+        d = self.sysdata[si.O_BACKPTR:si.O_BACKPTR+7]
+        return (d[0] << 24) + (d[1] << 16) + (d[5] << 8) + d[6]
+
+    @backptr.setter
+    def backptr(self, addr):
+        b = addr.to_bytes(4, 'big')
+        self.sysdata[si.O_BACKPTR:si.O_BACKPTR+2] = b[0:2]
+        self.sysdata[si.O_BACKPTR+5:si.O_BACKPTR+7] = b[2:4]
+
+    def now(self):
+        '''Station clock.'''
+        return datetime.now() + self.offset
+
+    def settime(self, data):
+        '''Set clock from C_SETTIME data.'''
+        self.offset = si.clock_time(data) - datetime.now()
+
+    def punch(self, card, t=None):
+        '''Punch card at station, store backup record.
+           Returns data of C_PUNCH autosend frame (after CN).'''
+        if t is None: t = self.now()
+        td, th, tl, tss = punchdata(t)
+        si3, si2, si1, si0 = card_bytes(card)
+        addr = self.backptr
+        date = ((t.year % 100) << 10) | (t.month << 6) | (t.day << 1) | (td & 0x01)
+        self.mem[addr:addr+si.BACKUP_REC] = (si2, si1, si0, date >> 8, date & 0xff, th, tl, tss)
+        self.backptr = addr + si.BACKUP_REC
+        return bytes((si3, si2, si1, si0, td, th, tl, tss, (addr >> 16) & 0xff, (addr >> 8) & 0xff, addr & 0xff))
+
+    def handle(self, command, data):
+        '''Execute command, return reply data (after CN) or None for NAK.'''
+        if command == si.C_GETDATA:
+            offset, num = data[0], data[1]
+            return bytes((offset,)) + bytes(self.sysdata[offset:offset+num])
+        if command == si.C_SETDATA:
+            offset = data[0]
+            self.sysdata[offset:offset+len(data)-1] = data[1:]
+            del self.sysdata[si.SYSDATA_SIZE:]
+            return bytes((offset,))
+        if command == si.C_GETMEM:
+            addr = (data[0] << 16) + (data[1] << 8) + data[2]
+            chunk = bytes(self.mem[addr:addr+data[3]])
+            return bytes(data[0:3]) + chunk + b'\xff' * (data[3] - len(chunk))
+        if command == si.C_GETTIME:
+            return bytes(si.timedata(self.now()))
+        if command == si.C_SETTIME:
+            self.settime(data)
+            return bytes(data)
+        if command == si.C_CLEARMEM:
+            self.mem[:] = b'\xff' * len(self.mem)
+            self.backptr = si.BACKUP_START
+            return b''
+        if command == si.C_BEEP:
+            self.beeps += data[0] if data else 1
+            return bytes(data)
+        if command == si.C_OFF:
+            return bytes(data) or bytes((command,))
+        if command in (si.C_GETSI5, si.C_GETSI6, si.C_GETSI8):
+            if self.card is None or self.card[0] != command:
+                return None
+            if command == si.C_GETSI5:
+                return self.card[1]
+            bn = data[0]
+            block = self.card[1][bn*si.CARD_BLOCK:(bn+1)*si.CARD_BLOCK]
+            if len(block) < si.CARD_BLOCK: return None
+            return bytes((bn,)) + block
+        return None
+
+## Pseudo-terminal ## ---------------------
+##################### ----------------------
+class Simulator():
+    '''Virtual master station on pseudo-terminal, with optional remote station.
+
+    Master station is connected at tty (e.g. 'pts/3', as Si takes it) after
+    start(). Input is ignored unless the port is set to station speed.
+    Replies are delayed by latency and sent at pace of speed (unless wiretime
+    is False). Fault injection: drop is probability of losing each reply
+    byte, corrupt is probability of one corrupted byte in a reply.
+    '''
+    def __init__(self, master=None, remote=None, speed=38400, latency=0, drop=0, corrupt=0,
+                 seed=None, wiretime=True):
+        self.master = master or SimStation()
+        self.remote = remote
+        self.speed = speed
+        self.latency = latency
+        self.drop = drop
+        self.corrupt = corrupt
+        self.wiretime = wiretime
+        self.random = random.Random(seed)
+        self.msmode = si.MODE_LOCAL
+        self.decoder = si.FrameDecoder(cn=False)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.frames = 0             # Commands received
+        self.ignored = 0            # Input bytes ignored for speed mismatch
+        self.dropped = 0            # Reply bytes dropped
+        self.corrupted = 0          # Replies corrupted
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        '''Create pseudo-terminal and start station thread.'''
+        self.fd, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.tty = os.ttyname(self.slave)[len('/dev/'):]
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='sisim-' + self.tty, daemon=True)
+        self.thread.start()
+        logging.debug("Simulated master station at /dev/{}.".format(self.tty))
+        return self
+
+    def stop(self):
+        '''Stop station thread and close pseudo-terminal.'''
+        if self.thread is None: return
+        self.running = False
+        self.thread.join()
+        self.thread = None
+        os.close(self.fd)
+        os.close(self.slave)
+
+    def speedok(self):
+        '''Port is set to station speed.'''
+        return termios.tcgetattr(self.slave)[5] == getattr(termios, 'B{}'.format(self.speed))
+
+    def run(self):
+        while self.running:
+            if not select.select([self.fd], [], [], 0.1)[0]:
+                continue
+            try:
+                data = os.read(self.fd, 1024)
+            except OSError:
+                break
+            if not self.speedok():
+                self.ignored += len(data)
+                continue
+            self.decoder.feed(data)
+            for frame in self.decoder:
+                self.frames += 1
+                speed = self.speed
+                reply = self.command(frame.command, frame.data)
+                if reply is not None:
+                    self.send(reply, speed)
+
+    def command(self, command, data):
+        '''Execute command, return reply (frame or NAK) or None for no reply.'''
+        master = self.master
+        if command == si.ACK:               # Card readout confirmed
+            master.beeps += 1
+            return None
+        if command == si.C_SETMSMODE:
+            self.msmode = data[0]
+            return mkframe(command, master.cn, data[0:1])
+        if command == si.C_SETSPEED:
+            if data[0] not in SPEEDS: return bytes((si.NAK,))
+            self.speed = SPEEDS[data[0]]    # Reply is sent at old speed
+            return mkframe(command, master.cn, data[0:1])
+        station = self.remote if self.msmode == si.MODE_REMOTE else master
+        if station is None:                 # No remote station in place
+            return None
+        reply = station.handle(command, data)
+        if reply is None:
+            return bytes((si.NAK,))
+        return mkframe(command, station.cn, reply)
+
+    def send(self, data, speed=None):
+        '''Write reply to port, with latency and faults.'''
+        data = bytearray(data)
+        if self.corrupt and len(data) > 1 and self.random.random() < self.corrupt:
+            data[self.random.randrange(1, len(data))] ^= 1 << self.random.randrange(8)
+            self.corrupted += 1
+        if self.drop:
+            kept = bytearray(b for b in data if self.random.random() >= self.drop)
+            self.dropped += len(data) - len(kept)
+            data = kept
+        if self.latency: time.sleep(self.latency)
+        if not self.wiretime:
+            with self.lock:
+                os.write(self.fd, data)
+            return
+        speed = speed or self.speed
+        step = max(speed // 1000, 1)        # Bytes sent in about 10 ms
+        for i in range(0, len(data), step):
+            with self.lock:
+                os.write(self.fd, data[i:i+step])
+            time.sleep(len(data[i:i+step]) * 10 / speed)
+
+#--------------------------------#
+    def punch(self, card, t=None):
+        '''Punch card at master station, send C_PUNCH if autosend is on.'''
+        master = self.master
+        data = master.punch(card, t)
+        if master.cpc & 0x02:
+            self.send(mkframe(si.C_PUNCH, master.cn, data))
+
+    def insert(self, card):
+        '''Insert card (si.Card) to master station, send card detected.'''
+        if card.cardtype == 5:
+            command, detected = si.C_GETSI5, si.C_INSI5
+        elif card.cardtype == 6:
+            command, detected = si.C_GETSI6, si.C_INSI6
+        else:
+            command, detected = si.C_GETSI8, si.C_INSI8
+        self.master.card = (command, card_memory(card))
+        self.cardno = card.card
+        self.send(mkframe(detected, self.master.cn, card_bytes(card.card)))
+
+    def remove(self):
+        '''Remove card from master station.'''
+        if self.master.card is None: return
+        self.master.card = None
+        self.send(mkframe(si.C_OUTSI, self.master.cn, card_bytes(self.cardno)))
+
+## Usage ## -------------------------------
+########### -------------------------------
+def Usage():
+    'Usage help'
+
+    usage = """
+
+Usage:
+    {script_name} [-hvqr] [-b <baud>] [-l <latency>] [-d <drop>] [-c <corrupt>] [-p <interval>]
+
+Simulated SI master station on pseudo-terminal, runs until Ctrl-C
+
+Parameters:
+    -h  ... help - this help
+    -v  ... more verbose
+    -q  ... more quiet = less verbose
+    -r  ... add remote station
+    -b <baud>     ... station speed {{38400, 4800}} [38400]
+    -l <latency>  ... reply latency in seconds [0]
+    -d <drop>     ... probability of dropped reply byte [0]
+    -c <corrupt>  ... probability of corrupted reply [0]
+    -p <interval> ... autosend random punches every <interval> seconds
+
+EOF
+"""
+    print(usage.format(script_name = sys.argv[0]))
+    return
+
+## Main ## --------------------------------
+########## --------------------------------
+def main():
+    '''Run simulated station'''
+    loglevel = logging.INFO
+    options = {}
+    remote = None
+    interval = None
+
+    args = sys.argv
+    i = 1
+    try:
+        while(i < len(args)):
+            if(args[i][0] == '-'):
+                for j in args[i][1:]:
+                    if j == 'h':
+                        Usage()
+                        return
+                    elif j == 'v':
+                        if loglevel > 10: loglevel -= 10
+                    elif j == 'q':
+                        if loglevel < 50: loglevel += 10
+                    elif j == 'r':
+                        remote = SimStation(cn=32, serial=500124)
+                    elif j == 'b':
+                        i += 1
+                        options['speed'] = int(args[i])
+                    elif j == 'l':
+                        i += 1
+                        options['latency'] = float(args[i])
+                    elif j == 'd':
+                        i += 1
+                        options['drop'] = float(args[i])
+                    elif j == 'c':
+                        i += 1
+                        options['corrupt'] = float(args[i])
+                    elif j == 'p':
+                        i += 1
+                        interval = float(args[i])
+            i += 1
+    except (IndexError, ValueError):
+        print("Parameter read error.")
+        Usage()
+        return
+
+    logging.basicConfig(format='%(levelname)s: %(message)s', level=loglevel)
+    sim = Simulator(SimStation(cpc=0x07 if interval else 0x05), remote, **options)
+    with sim:
+        print("Simulated master station at /dev/{}".format(sim.tty), flush=True)
+        try:
+            while True:
+                time.sleep(interval or 1)
+                if interval: sim.punch(random.randint(500000, 999999))
+        except KeyboardInterrupt:
+            pass
+    logging.info("Commands: {}, dropped bytes: {}, corrupted replies: {}".format(
+        sim.frames, sim.dropped, sim.corrupted))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -9,8 +9,12 @@
 #
 ################################################
 
-import os, logging, serial, time
-from datetime import datetime
+import os, logging, serial, time, random, json, asyncio, tempfile, threading, queue, struct, copy
+from collections import namedtuple, deque
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+np = None                   # NumPy, imported by _records on first use
 
 # Communication constants
 WAKE = 0xff
@@ -26,9 +30,30 @@ NODATA = 0x21
 BADCRC = 0x22
 BADATA = 0x23
 
+STATE_DIR = os.path.join(os.environ.get('XDG_STATE_HOME', os.path.expanduser('~/.local/state')), 'siadmin')
+
+PORT_CACHE = os.path.join(STATE_DIR, 'ports.json')   # Last working speed and CPC of master stations
+
 SI_VENDOR_ID = '10c4'
 SI_PRODUCT_ID = '800a'
 SI_CHUNK = 256
+SI_FRAMEMAX = 261   # STX, command, length, 255 bytes of data, CRC (2), ETX
+
+# Wire trace
+TRACE_MAGIC = b'SITRACE1'
+TRACE_RECORD = struct.Struct('<dBH')    # Time, direction, length, then raw bytes
+TRACE_IN   = 0      # Read from port (empty read is timeout)
+TRACE_OUT  = 1      # Written to port
+TRACE_OPEN = 2      # Port opened, data is baudrate (4 bytes)
+TRACE_SESSION = 3   # Trace (re)opened for appending, no data
+
+# I/O steps yielded by protocol generators of SiBase, done by Si.run and AsyncSi.run
+IO_WRITE = 0        # (IO_WRITE, command, data): frame and write command
+IO_READ  = 1        # (IO_READ,): read frame, result is status
+IO_SLEEP = 2        # (IO_SLEEP, seconds)
+IO_OPEN  = 3        # (IO_OPEN, baudrate): (re)open port
+IO_CLOSE = 4        # (IO_CLOSE,)
+IO_ACK   = 5        # (IO_ACK,): write ACK byte
 
 # Commands
 C_SETMSMODE = 0xf0 # mode
@@ -57,12 +82,17 @@ MODE_LOCAL = 0x4d
 MODE_REMOTE = 0x53
 SPEED_38400 = 0x01
 SPEED_4800  = 0x00
+SPEED_CODES = {38400: SPEED_38400, 4800: SPEED_4800}    # Baudrate -> C_SETSPEED parameter
+HIGHSPEED_MIN = 0x80    # Transfers at least this long are worth raising the speed
 
 # Offsets          # Len
+O_SERIAL    = 0x00 # 4
 O_FWVER     = 0x05 # 3
+O_MEMSIZE   = 0x0D # 1 (kB)
 O_BATALL    = 0x15 # 63
 O_BATDATE   = 0x15 # 3
 O_BATCAP    = 0x18 # 4
+O_BACKPTR   = 0x1C # 7 (pointer bytes 3, 2 at 0x1C, bytes 1, 0 at 0x21)
 O_BATCONS   = 0x34 # 4
 O_BATVOLT   = 0x50 # 2
 O_BATTEMP   = 0x52 # 2
@@ -70,6 +100,30 @@ O_MODE      = 0x71 # 1
 O_CODE      = 0x72 # 1
 O_PROT      = 0x74 # 1
 
+SYSDATA_SIZE = 0x80     # System data block 0x00 - 0x7F
+SYSDATA_MAXAGE = 5.0    # Seconds the system data snapshot is trusted
+
+# Backup memory
+BACKUP_START = 0x100    # Address of first record
+BACKUP_REC   = 8        # Record length (extended protocol)
+MEM_CHUNK    = 0x80     # Maximum bytes in one C_GETMEM
+
+# Time synchronisation
+SYNC_PROBES  = 3        # C_GETTIME round trips measured before setting time
+
+# Autosend listener
+LISTEN_QUEUE = 1000     # Events kept for slow consumer, oldest are dropped
+
+# Card memory
+CARD_BLOCK   = 0x80     # Block size of C_GETSI6 / C_GETSI8
+CARD_COMMANDS = {5: C_GETSI5, 6: C_GETSI6}    # Card type -> read command, other types C_GETSI8
+SI8_SERIES = {1: 0x38, 2: 0x88, 4: 0xB0, 15: 0x200}  # Card series -> punches address (SI9, SI8, pCard, SI10/11/SIAC)
+SI5_NULL = 0xEEEE       # No time in SI5 card
+
+# Backup record (extended protocol): SI2, SI1, SI0, DATE1, DATE0, TH, TL, MS
+# DATE1 = yyyyyymm, DATE0 = mmdddddp (p = PM), MS = 1/256 s
+PUNCH_COLUMNS = ('cn', 'card', 'seconds', 'subsec', 'dow', 'valid')
+
 MODES = ('Undef', 'SIAC_x', 'Control', 'Start', 'Finish', 'Readout', 'Undef', 'Clear', 'Undef', 'Undef', 'Check',
          'Undef', 'Undef', 'Undef', 'Undef', 'Undef', 'Undef', 'SIAC_test', 'Undef', 'Undef', 'Undef')
 
@@ -89,46 +143,40 @@ class SiException(Exception):
 # SI auxiliary functions
 ##################################
 
+#--------------------------------#
+def _crc_table():
+    """Precompute CRC of every possible high byte shifted out of the register."""
+    table = []
+    for i in range(256):
+        sum0 = i << 8
+        for k in range(8):
+            if sum0 & 0x8000:
+                sum0 = ((sum0 << 1) & 0xFFFF) ^ 0x8005
+            else:
+                sum0 = (sum0 << 1) & 0xFFFF
+        table.append(sum0)
+    return tuple(table)
+
+CRC_TABLE = _crc_table()
+
 #--------------------------------#
 def crc_l(length, data):
-    """CRC computation."""
-    Polynom = 0x8005;
-    Bitmask = 0x8000;
-    Intmask = 0xFFFF;
+    """CRC computation.
 
-    p = 0
+    Table driven, byte at a time. Data are shifted through the register
+    after the first word, odd length is padded by one zero byte, even
+    length by a zero word.
+    """
     if length < 2: return 0
-    sum0 = data[p]
-    p += 1
-    sum0 = (sum0 << 8) + data[p]
-    p += 1
-
+    sum0 = (data[0] << 8) + data[1]
     if length == 2: return sum0
 
-    i = length >> 1
-    while i > 0:
-        if i > 1:
-            sum1 = data[p]
-            p += 1
-            sum1 = ((sum1 << 8) & Intmask) + data[p]
-            p += 1
-        else:
-            if length & 1:
-                sum1 = data[p] << 8
-                p += 1
-            else:
-                sum1 = 0
-
-        for k in range(0,16):
-            if sum0 & Bitmask:
-                sum0 = (sum0 << 1) & Intmask
-                if sum1 & Bitmask: sum0 = sum0 + 1 & Intmask
-                sum0 ^= Polynom
-            else:
-                sum0 = (sum0 << 1) & Intmask
-                if sum1 & Bitmask: sum0 = sum0 + 1 & Intmask
-            sum1 = (sum1 << 1) & Intmask
-        i -= 1
+    table = CRC_TABLE
+    for p in range(2, length):
+        sum0 = (((sum0 & 0xff) << 8) | data[p]) ^ table[sum0 >> 8]
+    sum0 = ((sum0 & 0xff) << 8) ^ table[sum0 >> 8]
+    if not length & 1:
+        sum0 = ((sum0 & 0xff) << 8) ^ table[sum0 >> 8]
     return sum0
 
 #--------------------------------#
@@ -138,21 +186,125 @@ def crc(data):
     return crc_l(length, data)
 
 #--------------------------------#
-def station_detect():
-    """Detect device of connected SI master station."""
-    devices = []
+def timedata(t):
+    '''Convert datetime to data of C_SETTIME command.'''
+    if t.hour >= 12:
+        is_pm = 1
+        hour = t.hour - 12
+    else:
+        is_pm = 0
+        hour = t.hour
+    td = ((t.isoweekday() % 7) << 1) + is_pm
+    secs = hour * 3600 + t.minute * 60 + t.second
+    tss = round(t.microsecond * 256 / 1000000)
+    if tss == 256:              # Rounded up to the next second
+        return timedata(t.replace(microsecond=0) + timedelta(seconds=1))
+    return (t.year % 100, t.month, t.day, td, (secs >> 8) & 0xff, secs & 0xff, tss)
+
+def clock_time(data):
+    '''Convert data of C_GETTIME reply (yy, mm, dd, td, th, tl, tss) to datetime.'''
+    yy, mm, dd, td, th, tl, tss = data[0:7]
+    secs = (th << 8) + tl + (td & 0x01) * 43200
+    return datetime(2000 + yy, mm or 1, dd or 1) + timedelta(seconds=secs + tss / 256)
+
+#--------------------------------#
+def logdata(prefix, data):
+    '''Debug log of raw data, hex dump is made only if debug is on.'''
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(prefix + data.hex(':'))
+
+#--------------------------------#
+def usb_device(name, sysfs='/sys'):
+    """Return sysfs directory of USB device providing tty name (e.g. ttyUSB0) or None."""
+    try:
+        port = os.path.realpath(os.path.join(sysfs, 'class', 'tty', name, 'device'))
+    except OSError:
+        return None
+    idroot = os.path.dirname(os.path.dirname(port))     # Two levels up from port
+    if os.path.isfile(idroot+"/idVendor") and os.path.isfile(idroot+"/idProduct"):
+        return idroot
+    return None
 
-    for root, dirs, files in os.walk('/sys/devices'):
-        if os.path.basename(root).startswith('ttyUSB'):
-            idroot = os.path.dirname(os.path.dirname(root))   # Two levels up
-            if os.path.isfile(idroot+"/idVendor") and os.path.isfile(idroot+"/idProduct"):
-                with open(idroot+"/idVendor") as f:
-                    vendor = f.read().replace('\n', '')
-                with open(idroot+"/idProduct") as f:
-                    product = f.read().replace('\n', '')
-                if vendor == SI_VENDOR_ID and product == SI_PRODUCT_ID:
-                    devices.append(os.path.basename(root))
-    return devices
+#--------------------------------#
+def port_key(tty, sysfs='/sys'):
+    """Identification of master station at tty: USB serial number or device path."""
+    idroot = usb_device(os.path.basename(tty), sysfs)
+    if idroot is not None:
+        try:
+            with open(idroot+"/serial") as f:
+                return 'usb:' + f.read().strip()
+        except OSError:
+            pass
+    return '/dev/' + tty
+
+#--------------------------------#
+def is_station(name, sysfs='/sys'):
+    """Check vendor and product ID of device behind tty name."""
+    idroot = usb_device(name, sysfs)
+    if idroot is None: return False
+    try:
+        with open(idroot+"/idVendor") as f:
+            vendor = f.read().replace('\n', '')
+        with open(idroot+"/idProduct") as f:
+            product = f.read().replace('\n', '')
+    except OSError:
+        return False
+    return vendor == SI_VENDOR_ID and product == SI_PRODUCT_ID
+
+#--------------------------------#
+def tty_key(name):
+    """Sort key of tty names (ttyUSB2 before ttyUSB10)."""
+    prefix = name.rstrip('0123456789')
+    num = name[len(prefix):]
+    return (prefix, int(num) if num else -1)
+
+#--------------------------------#
+def station_detect(sysfs='/sys'):
+    """Detect device of connected SI master station.
+       Only ttyUSB entries of /sys/class/tty are checked."""
+    try:
+        names = os.listdir(os.path.join(sysfs, 'class', 'tty'))
+    except OSError:
+        return []
+    return [name for name in sorted(names, key=tty_key)
+            if name.startswith('ttyUSB') and is_station(name, sysfs)]
+
+#--------------------------------#
+class StationWatch():
+    '''Watch SI master stations being plugged in and removed.
+
+    Each poll lists /sys/class/tty only, vendor and product IDs are read
+    just for newly appeared ttys. Iteration yields ('add', tty) and
+    ('remove', tty) events, currently connected stations are in stations.
+    '''
+    def __init__(self, sysfs='/sys', interval=0.5):
+        self.sysfs = sysfs
+        self.interval = interval
+        self.stations = []
+        self.known = {}             # tty name -> is SI station
+
+    def poll(self):
+        '''Check for changes, return list of events.'''
+        try:
+            names = set(n for n in os.listdir(os.path.join(self.sysfs, 'class', 'tty')) if n.startswith('ttyUSB'))
+        except OSError:
+            names = set()
+        events = []
+        for name in sorted(names - self.known.keys(), key=tty_key):
+            self.known[name] = is_station(name, self.sysfs)
+            if self.known[name]:
+                events.append(('add', name))
+        for name in sorted(self.known.keys() - names, key=tty_key):
+            if self.known.pop(name):
+                events.append(('remove', name))
+        self.stations = sorted((n for n, st in self.known.items() if st), key=tty_key)
+        return events
+
+    def __iter__(self):
+        while True:
+            for event in self.poll():
+                yield event
+            time.sleep(self.interval)
 
 #--------------------------------#
 def set_bit(val, index, bitval):
@@ -165,33 +317,666 @@ def set_bit(val, index, bitval):
 #--------------------------------#
 
 ##################################
-# SI main class
+# Persistent state
 ##################################
-class Si():
-    '''SI master station class'''
-    def __init__(self, tty):
-        '''Initialize serial communication with SI master station.'''
-        self.tty = tty
-        bauds = (38400, 4800)
-        for baudrate in bauds:
-            try:
-                self.dev = serial.Serial('/dev/'+tty, baudrate, timeout=0.2)   # Timeout 0.2 sec is reliable
-                self.handshake(C_SETMSMODE, (MODE_LOCAL,), 1)
-            except SiException: self.dev.close()
-            else: break
+class StateFile():
+    '''Small persistent dictionary stored as JSON file.
+       Only keys changed here are written on save, so more instances
+       (e.g. threads of fleet mode) can share one file.'''
+    lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+        self.data = self.load()
+        self.changed = set()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logging.debug("State file {} not loaded: {}".format(self.path, e))
+            return {}
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+        self.changed.add(key)
+
+    def __delitem__(self, key):
+        self.data.pop(key, None)
+        self.changed.add(key)
+
+    def save(self):
+        '''Write changed keys to state file (atomically).'''
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(dirname, exist_ok=True)
+        with self.lock:
+            data = self.load()
+            for key in self.changed:
+                if key in self.data: data[key] = self.data[key]
+                else: data.pop(key, None)
+            fd, tmp = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.path)
+        self.changed.clear()
+
+##################################
+# Retry policy
+##################################
+class RetryPolicy():
+    '''Retry policy for write - read cycles with station.
+
+    First retry is immediate, next ones wait delay * factor**n seconds
+    (at most maxdelay), randomized by +- jitter fraction. NAK and bad CRC
+    mean the station is in contact, they are retried without waiting,
+    repeated NAK (command refused) at most naktries times. No answer
+    (NODATA) backs off. Whole command is limited by deadline seconds.
+    '''
+    def __init__(self, tries=5, delay=0.1, factor=2, maxdelay=1.0, jitter=0,
+                 deadline=4.0, naktries=2, immediate=True):
+        self.tries = tries
+        self.delay = delay
+        self.factor = factor
+        self.maxdelay = maxdelay
+        self.jitter = jitter
+        self.deadline = deadline
+        self.naktries = naktries
+        self.immediate = immediate
+
+    def __str__(self):
+        return ("tries={}, delay={}, factor={}, maxdelay={}, jitter={}, deadline={}, naktries={}"
+                .format(self.tries, self.delay, self.factor, self.maxdelay, self.jitter,
+                        self.deadline, self.naktries))
+
+    def wait(self, attempt, naks, status, elapsed):
+        '''Return delay before next try or None to give up.
+           attempt ... failed tries so far, naks ... NAKs among them,
+           status ... status of last try, elapsed ... seconds since first try.'''
+        if status == NAK and self.naktries is not None and naks > self.naktries:
+            return None
+        if status in (NAK, BADCRC) and self.immediate:
+            delay = 0
+        elif attempt == 1 and self.immediate:
+            delay = 0
         else:
-            raise SiException("Cannot set baudrate.")
+            n = attempt - 2 if self.immediate else attempt - 1
+            delay = min(self.delay * self.factor ** n, self.maxdelay)
+            if self.jitter:
+                delay *= 1 + random.uniform(-self.jitter, self.jitter)
+        if self.deadline is not None and elapsed + delay > self.deadline:
+            return None
+        return delay
 
-        self.cn = (self.rdata[2] << 8) + self.rdata[3]
-        self.speed = baudrate
-        self.handshake_tries = 5
-        self.refreshprot()
+# Named policies selectable from command line
+RETRY_POLICIES = {
+    'fixed':  RetryPolicy(delay=1, factor=1, deadline=None, naktries=None, immediate=False),  # Original behaviour
+    'expo':   RetryPolicy(),
+    'jitter': RetryPolicy(jitter=0.5),
+}
+RETRY_DEFAULT = 'expo'
+
+##################################
+# Command statistics
+##################################
+STATUS_NAMES = {DATAOK: 'ok', NODATA: 'nodata', BADCRC: 'badcrc', NAK: 'nak', ACK: 'ack'}
+RTT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)    # Histogram upper bounds (ms)
+
+class Stats():
+    '''Counters and round trip histogram per command code.
+
+    Filled by handshake and siread of station with stats set, exported
+    by as_dict(). Round trip is time from write to valid reply of one try.
+    '''
+    def __init__(self):
+        self.commands = {}
+        self.current = None         # Entry of command in progress
+
+    def start(self, command):
+        '''Command handshake started.'''
+        entry = self.commands.get(command)
+        if entry is None:
+            entry = self.commands[command] = {
+                'calls': 0, 'failed': 0, 'tries': 0, 'sent': 0, 'received': 0, 'sleep': 0.0,
+                'status': dict.fromkeys(STATUS_NAMES.values(), 0),
+                'rtt': {'count': 0, 'sum': 0.0, 'min': None, 'max': None,
+                        'hist': [0] * (len(RTT_BUCKETS) + 1)}}
+        entry['calls'] += 1
+        self.current = entry
+
+    def attempt(self, sent, status, rtt):
+        '''One write - read try, rtt in seconds.'''
+        entry = self.current
+        entry['tries'] += 1
+        entry['sent'] += sent
+        entry['status'][STATUS_NAMES.get(status, 'nodata')] += 1
+        if status != DATAOK: return
+        ms = rtt * 1000
+        r = entry['rtt']
+        r['count'] += 1
+        r['sum'] += ms
+        r['min'] = ms if r['min'] is None else min(r['min'], ms)
+        r['max'] = ms if r['max'] is None else max(r['max'], ms)
+        i = 0
+        while i < len(RTT_BUCKETS) and ms > RTT_BUCKETS[i]: i += 1
+        r['hist'][i] += 1
+
+    def received(self, count):
+        '''Bytes read from port.'''
+        if self.current is not None:
+            self.current['received'] += count
+
+    def sleep(self, delay):
+        '''Time waiting before retry.'''
+        self.current['sleep'] += delay
+
+    def done(self, ok):
+        '''Command handshake finished.'''
+        if not ok: self.current['failed'] += 1
+        self.current = None
+
+    def as_dict(self):
+        '''Statistics as JSON serializable dict, commands by hex code.'''
+        labels = ['<={}ms'.format(b) for b in RTT_BUCKETS] + ['>{}ms'.format(RTT_BUCKETS[-1])]
+        commands = {}
+        total = dict.fromkeys(('calls', 'failed', 'tries', 'sent', 'received', 'sleep'), 0)
+        for command, entry in sorted(self.commands.items()):
+            e = dict(entry, status=dict(entry['status']), rtt=dict(entry['rtt']))
+            r = e['rtt']
+            r['mean'] = r['sum'] / r['count'] if r['count'] else None
+            for key in ('sum', 'min', 'max', 'mean'):
+                if r[key] is not None: r[key] = round(r[key], 3)
+            e['sleep'] = round(e['sleep'], 3)
+            r['hist'] = dict(zip(labels, r['hist']))
+            e['retries'] = e['tries'] - e['calls']
+            commands['0x{:02x}'.format(command)] = e
+            for key in total:
+                total[key] += entry[key]
+        total['retries'] = total['tries'] - total['calls']
+        total['sleep'] = round(total['sleep'], 3)
+        return {'commands': commands, 'total': total}
+
+##################################
+# Wire trace
+##################################
+class WireTrace():
+    '''Binary trace of port traffic, appended to file.
+
+    Each record is TRACE_RECORD header (time, direction, length) followed
+    by raw bytes. Records are buffered, close() (or flush()) writes them.
+    Each WireTrace starts a new session by TRACE_SESSION record.
+    '''
+    def __init__(self, path):
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(TRACE_MAGIC)
+        self.lock = threading.Lock()
+        self.record(TRACE_SESSION, b'')
+
+    def record(self, direction, data):
+        with self.lock:
+            self.file.write(TRACE_RECORD.pack(time.time(), direction, len(data)) + data)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+def read_trace(path):
+    '''Generator of trace records (time, direction, data).'''
+    with open(path, 'rb') as f:
+        if f.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+            raise SiException("{} is not a wire trace.".format(path))
+        while True:
+            header = f.read(TRACE_RECORD.size)
+            if len(header) < TRACE_RECORD.size: return
+            t, direction, length = TRACE_RECORD.unpack(header)
+            yield t, direction, f.read(length)
+
+class ReplaySerial():
+    '''Serial port replaying recorded trace, pass it as transport to Si.
+
+    Reads return recorded input in the recorded order without waiting
+    (empty read is timeout), writes are compared with recorded output.
+    Port opens follow the recorded ones, so replay with the same retry
+    policy and no port cache (cache=None). Only the last session of the
+    trace is replayed.
+    '''
+    def __init__(self, path):
+        self.records = list(read_trace(path))
+        sessions = [i for i, r in enumerate(self.records) if r[1] == TRACE_SESSION]
+        self.pos = sessions[-1] + 1 if sessions else 0
+        self.pending = b''          # Rest of the current input record
+        self.baudrate = None
+        self.timeout = None
+        self.mismatch = 0           # Writes different from recording
+
+    def __call__(self, port, baudrate, timeout=None):
+        '''Open port (transport factory interface).'''
+        while self.pos < len(self.records) and self.records[self.pos][1] != TRACE_OPEN:
+            self.pos += 1
+        if self.pos == len(self.records):
+            raise serial.SerialException("Replay: no more port opens in trace.")
+        self.baudrate = int.from_bytes(self.records[self.pos][2], 'big')
+        if self.baudrate != baudrate:
+            logging.warning("Replay: port opened at {}, recorded {}.".format(baudrate, self.baudrate))
+        self.timeout = timeout
+        self.pos += 1
+        self.pending = b''
+        return self
+
+    def next(self, direction):
+        '''Data of next record of direction, None if other record follows.'''
+        if self.pos < len(self.records) and self.records[self.pos][1] == direction:
+            self.pos += 1
+            return self.records[self.pos-1][2]
+        return None
+
+    @property
+    def in_waiting(self):
+        return len(self.pending)
+
+    def read(self, size=1):
+        if not self.pending:
+            data = self.next(TRACE_IN)
+            if not data: return b''     # Recorded timeout or end of replies
+            self.pending = data
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+    def write(self, data):
+        recorded = self.next(TRACE_OUT)
+        if recorded != bytes(data):
+            self.mismatch += 1
+            logging.warning("Replay: written data differ from recording.")
+        return len(data)
+
+    def close(self):
+        pass
+
+##################################
+# Incremental frame decoder
+##################################
+Frame = namedtuple('Frame', 'command cn data')
+Frame.__doc__ = '''Received frame. NAK and ACK control bytes come as frames with cn None.'''
+
+class FrameDecoder():
+    '''Decode SI frames from arbitrary chunks of input data.
+
+    Data are appended by feed(), complete frames with valid CRC are taken
+    by next() or by iteration. Partial frame is kept for the next feed,
+    WAKE bytes and noise between frames are skipped.
+    Frames sent by station carry its code (CN), commands sent to the
+    station do not (decode them with cn=False).
+    '''
+    def __init__(self, cn=True):
+        self.hascn = cn
+        self.buf = bytearray()
+        self.pos = 0            # Start of unprocessed data in buf
+        self.badcrc = 0         # Frames dropped for bad CRC
+        self.noise = 0          # Bytes skipped outside of frames
+
+    def feed(self, data):
+        '''Append received data.'''
+        if self.pos:
+            del self.buf[:self.pos]
+            self.pos = 0
+        self.buf += data
+
+    def clear(self):
+        '''Drop all buffered data.'''
+        self.buf = bytearray()
+        self.pos = 0
+
+    def missing(self):
+        '''Number of bytes missing to the end of the frame in progress.
+           Returns 0 if no frame is in progress or the frame is complete.'''
+        start = self.buf.find(STX, self.pos)
+        if start < 0: return 0
+        while start + 1 < len(self.buf) and self.buf[start+1] == STX:  # Doubled STX
+            start += 1
+        have = len(self.buf) - start
+        if have < 3: return 3 - have
+        return max(self.buf[start+2] + 6 - have, 0)
+
+    def resync(self):
+        '''Give up the frame in progress (e.g. started by noise STX).'''
+        start = self.buf.find(STX, self.pos)
+        if start >= 0:
+            self.noise += 1
+            self.pos = start + 1
+
+    def __iter__(self):
+        while True:
+            frame = self.next()
+            if frame is None: return
+            yield frame
+
+    def next(self):
+        '''Return next complete frame or None if there is none.'''
+        buf = self.buf
+        end = len(buf)
+        pos = self.pos
+        while pos < end:
+            d = buf[pos]
+            if d == NAK or d == ACK:
+                self.pos = pos + 1
+                return Frame(d, None, b'')
+            if d != STX:
+                if d != WAKE: self.noise += 1
+                pos += 1
+                continue
+            if pos + 1 < end and buf[pos+1] == STX:  # Doubled STX
+                pos += 1
+                continue
+            if end - pos < 3: break
+            length = buf[pos+2]
+            if end - pos < length + 6: break        # Incomplete frame
+            with memoryview(buf) as mv:
+                frame = mv[pos+1:pos+length+5]
+                data_crc = (frame[length+2] << 8) + frame[length+3]
+                comp_crc = crc_l(length+2, frame)
+                if data_crc == comp_crc:
+                    if self.hascn and length >= 2:
+                        result = Frame(frame[0], (frame[2] << 8) + frame[3], bytes(frame[4:length+2]))
+                    else:
+                        result = Frame(frame[0], None, bytes(frame[2:length+2]))
+                frame.release()
+            if data_crc == comp_crc:
+                self.pos = pos + length + 6
+                return result
+            logging.warning("Bad CRC. Received: {}, Computed: {}".format(data_crc, comp_crc))
+            self.badcrc += 1
+            # Resynchronize on next STX inside the rejected frame, its other bytes are not ACK/NAK
+            resync = buf.find(STX, pos + 1, pos + length + 6)
+            pos = resync if resync >= 0 else pos + length + 6
+        self.pos = pos
+        return None
+
+##################################
+# Autosend events
+##################################
+Event = namedtuple('Event', 'kind cn card cardtype dow time mem')
+Event.__doc__ = '''Autosend event. Kind is 'punch', 'insert' or 'remove'.
+Punch time is in seconds after midnight (with subseconds), dow 0 is Sunday.
+Time, dow and backup memory address are None for card events.'''
+
+EVENT_KINDS = {C_PUNCH: 'punch', C_INSI5: 'insert', C_INSI6: 'insert', C_INSI8: 'insert', C_OUTSI: 'remove'}
+
+def card_number(si3, si2, si1, si0):
+    '''Card number and type from 4 byte card number (as si_num_type).'''
+    if si2 == 1: si2 = 0
+    if si2 <= 4:
+        return (100000 * si2 + (si1 << 8) + si0, 5)
+    num = (si2 << 16) + (si1 << 8) + si0
+    for low, high, cardtype in ((0, 1000000, 6), (1000000, 2000000, 9), (2000000, 3000000, 8),
+                                (4000001, 5000000, 20), (6000001, 7000000, 21), (7000001, 8000000, 10),
+                                (8000001, 9000000, 30), (9000001, 10000000, 11), (14000001, 15000000, 22),
+                                (16711681, 16777216, 26)):
+        if low <= num < high:
+            return (num, cardtype)
+    return (num, 0)
+
+def punch_time(td, th, tl, tss=0):
+    '''Day of week and seconds after midnight from punch time bytes, dow 7 is no data.'''
+    dow = (td >> 1) & 0x07
+    if dow == 7: return (7, None)
+    t = (th << 8) + tl
+    if td & 0x01: t += 43200        # PM
+    return (dow, t + tss / 256)
+
+def autosend_event(frame):
+    '''Make Event from autosend frame, None for other frames.'''
+    kind = EVENT_KINDS.get(frame.command)
+    d = frame.data
+    if kind is None or len(d) < 4: return None
+    card, cardtype = card_number(*d[0:4])
+    if kind != 'punch':
+        return Event(kind, frame.cn, card, cardtype, None, None, None)
+    if len(d) < 11: return None
+    dow, t = punch_time(*d[4:8])
+    return Event(kind, frame.cn, card, cardtype, dow, t, (d[8] << 16) + (d[9] << 8) + d[10])
+
+##################################
+# Card readout
+##################################
+Punch = namedtuple('Punch', 'cn dow time')
+Punch.__doc__ = '''Punch in card, time in seconds after midnight, None if missing.'''
+
+Card = namedtuple('Card', 'card cardtype start finish check punches')
+Card.__doc__ = '''Card readout. Start, finish and check are Punch or None, punches is tuple of Punch.'''
+
+def punch4(d):
+    '''Punch from 4 byte record PTD, CN, PTH, PTL (SI6/8/9/10/11/p/SIAC), None if no data.'''
+    dow, t = punch_time(d[0], d[2], d[3])
+    if t is None: return None
+    return Punch(d[1] + (((d[0] >> 6) & 0x03) << 8), dow, t)
+
+def punch_addrs(command, block0):
+    '''Card memory addresses of punch records, from block 0.'''
+    if command == C_GETSI6:
+        count = block0[0x12]
+        # Blocks 6, 7 hold punches 1-64, blocks 2-5 punches 65-192 (SI6*)
+        return [0x300 + 4 * i if i < 64 else 0x100 + 4 * (i - 64) for i in range(count)]
+    count = block0[0x16]
+    series = block0[0x18] & 0x0F
+    if series not in SI8_SERIES:
+        raise SiException("Unknown card series {}.".format(series))
+    return [SI8_SERIES[series] + 4 * i for i in range(count)]
+
+def card_blocks(command, block0):
+    '''Blocks other than 0 to read, only those holding punches.'''
+    return sorted({a // CARD_BLOCK for a in punch_addrs(command, block0)} - {0})
+
+def parse_si5(d, start=0):
+    '''Parse SI5 card data (128 bytes). Times are 12 hour, times before start
+       (seconds, as in si_parse_data) are taken as PM.'''
+    def t5(offset):
+        t = (d[offset] << 8) + d[offset+1]
+        if t == SI5_NULL: return None
+        return t + 43200 if t < start else t
+    def p5(offset, cn=0):
+        t = t5(offset)
+        return None if t is None else Punch(cn, None, t)
+    punches = []
+    for i in range(d[0x17] - 1):
+        if i < 30:
+            o = 0x21 + 3 * i + i // 5
+            punches.append(Punch(d[o], None, t5(o+1)))
+        else:                       # Last six punches without time
+            punches.append(Punch(d[0x20 + (i - 30) * 0x10], None, None))
+    card, cardtype = card_number(0, d[6], d[4], d[5])
+    return Card(card, cardtype, p5(0x13), p5(0x15), p5(0x19), tuple(punches))
+
+def parse_card(command, blocks, start=0):
+    '''Parse card data, blocks is dict {block number: data}.'''
+    b0 = blocks[0]
+    if command == C_GETSI5:
+        return parse_si5(b0, start)
+    punches = []
+    for a in punch_addrs(command, b0):
+        block = blocks[a // CARD_BLOCK]
+        o = a % CARD_BLOCK
+        punches.append(punch4(block[o:o+4]) or Punch(block[o+1], None, None))
+    if command == C_GETSI6:
+        card, cardtype = card_number(*b0[10:14])
+        return Card(card, cardtype, punch4(b0[24:28]), punch4(b0[20:24]), punch4(b0[28:32]), tuple(punches))
+    card, cardtype = card_number(*b0[24:28])
+    return Card(card, cardtype, punch4(b0[12:16]), punch4(b0[16:20]), punch4(b0[8:12]), tuple(punches))
+
+##################################
+# Vectorized punch decoding
+##################################
+def _records(data, size):
+    '''View bytes buffer as 2D array of records (incomplete last record is ignored).'''
+    global np
+    if np is None:
+        try:
+            import numpy as np
+        except ImportError:
+            raise SiException("Vectorized punch decoding needs NumPy.")
+    buf = np.frombuffer(data, dtype=np.uint8)
+    return buf[:len(buf) // size * size].reshape(-1, size)
+
+def _card_numbers(si2, si1, si0):
+    '''Card numbers from 3 card number bytes, as card_number.'''
+    si2 = si2.astype(np.uint32)
+    low = (si1.astype(np.uint32) << 8) | si0
+    series = np.where(si2 == 1, 0, si2)
+    return np.where(si2 <= 4, series * 100000 + low, (si2 << 16) | low)
+
+def decode_punches(data, card=0, subsec=False):
+    '''Decode 4 byte punch records (PTD, CN, PTH, PTL as punch4) to dict of
+       column arrays (see PUNCH_COLUMNS). With subsec the CN byte holds
+       1/256 s and CN is 0 (as si_mkpunch4). Records with dow 7 or time
+       0xEEEE are not valid, their other columns are 0.'''
+    r = _records(data, 4)
+    td = r[:, 0]
+    t = (r[:, 2].astype(np.uint32) << 8) | r[:, 3]
+    dow = (td >> 1) & 0x07
+    valid = (dow != 7) & (t != SI5_NULL)
+    seconds = t + np.where(td & 0x01, 43200, 0)
+    if subsec:
+        cn = np.zeros(len(r), dtype=np.uint16)
+        sub = r[:, 1].copy()
+    else:
+        cn = ((td.astype(np.uint16) >> 6) << 8) | r[:, 1]
+        sub = np.zeros(len(r), dtype=np.uint8)
+    return _columns(cn, np.full(len(r), card, dtype=np.uint32), seconds, sub, dow, valid)
+
+def decode_backup(data, cn=0):
+    '''Decode 8 byte backup records (see BACKUP_REC) of station cn to dict of
+       column arrays. Day of week is computed from record date. Records with
+       bad date or time 0xEEEE (unwritten or empty memory) are not valid.'''
+    r = _records(data, 8)
+    date = (r[:, 3].astype(np.uint16) << 8) | r[:, 4]
+    year = date >> 10
+    month = (date >> 6) & 0x0F
+    day = (date >> 1) & 0x1F
+    t = (r[:, 5].astype(np.uint32) << 8) | r[:, 6]
+    valid = (month >= 1) & (month <= 12) & (day >= 1) & (t != SI5_NULL) & (t < 43200)
+    # Days since 1970-01-01 of the first day of each month of years 2000 - 2064
+    first = (np.arange(30 * 12, 95 * 12 + 1).astype('datetime64[M]').astype('datetime64[D]')
+             .astype(np.int64))
+    months = year.astype(np.intp) * 12 + np.clip(month, 1, 12) - 1
+    valid &= day <= first[months + 1] - first[months]
+    dow = ((first[months] + day + 3) % 7).astype(np.uint8)      # 1970-01-01 is Thursday
+    seconds = t + np.where(date & 0x01, 43200, 0)
+    return _columns(np.full(len(r), cn, dtype=np.uint16), _card_numbers(r[:, 0], r[:, 1], r[:, 2]),
+                    seconds, r[:, 7].copy(), dow, valid)
+
+def _columns(cn, card, seconds, subsec, dow, valid):
+    '''Column dict, invalid records zeroed.'''
+    columns = dict(zip(PUNCH_COLUMNS, (cn, card.astype(np.uint32), seconds.astype(np.uint32),
+                                       subsec, dow.astype(np.uint8), valid)))
+    for name in PUNCH_COLUMNS[:-1]:
+        columns[name][~valid] = 0
+    return columns
+
+##################################
+# System data snapshot
+##################################
+class SystemData():
+    '''Snapshot of station system data (offsets 0x00 - 0x7F).
+
+    Bytes are valid once read and until invalidated (e.g. by a write) or
+    until the snapshot is older than maxage seconds.
+    '''
+    def __init__(self, maxage=SYSDATA_MAXAGE):
+        self.buf = bytearray(SYSDATA_SIZE)
+        self.valid = bytearray(SYSDATA_SIZE)    # 1 for valid byte
+        self.maxage = maxage
+        self.time = 0                           # Time of first read into empty snapshot
+        self.full = False                       # All bytes were read since snapshot was empty
+
+    def invalidate(self, offset=0, length=SYSDATA_SIZE):
+        '''Mark bytes as not read.'''
+        self.valid[offset:offset+length] = bytes(len(self.valid[offset:offset+length]))
+        if not any(self.valid): self.full = False
+
+    def empty(self):
+        if self.maxage is not None and time.monotonic() - self.time > self.maxage:
+            self.invalidate()
+        return not any(self.valid)
+
+    def missing(self, offset, length):
+        '''Return (offset, length) of the span to read so that given bytes are valid, or None.'''
+        if self.empty(): return (offset, length)
+        bad = [i for i in range(offset, offset+length) if not self.valid[i]]
+        if not bad: return None
+        return (bad[0], bad[-1] - bad[0] + 1)
+
+    def update(self, offset, data):
+        '''Store bytes read from station.'''
+        if self.empty(): self.time = time.monotonic()
+        self.buf[offset:offset+len(data)] = data
+        self.valid[offset:offset+len(data)] = b'\x01' * len(data)
+        if all(self.valid): self.full = True
+
+    def get(self, offset, length):
+        return bytes(self.buf[offset:offset+length])
+
+    # Parsed fields
+    @property
+    def serial(self):
+        return int.from_bytes(self.buf[O_SERIAL:O_SERIAL+4], 'big')
+
+    @property
+    def mode(self):
+        return self.buf[O_MODE]
+
+    @property
+    def cn(self):
+        return self.buf[O_CODE]
+
+    @property
+    def cpc(self):
+        return self.buf[O_PROT]
+
+    @property
+    def memsize(self):
+        return self.buf[O_MEMSIZE] * 1024
+
+    @property
+    def backptr(self):
+        d = self.buf[O_BACKPTR:O_BACKPTR+7]
+        return (d[0] << 24) + (d[1] << 16) + (d[5] << 8) + d[6]
+
+##################################
+# SI protocol base (no I/O)
+##################################
+class SiBase():
+    '''Framing, decoding, protocol state and protocol steps shared by blocking
+    and asyncio station classes, which add only their I/O (run).'''
+    timeout = 0.2       # Timeout 0.2 sec is reliable
+
+    def __init__(self, tty, retry=None):
+        self.tty = tty
+        self.retry = retry or RETRY_POLICIES[RETRY_DEFAULT]
+        self.decoder = FrameDecoder()
+        self.replies = deque(maxlen=8)  # Replies taken out of decoder by dispatch
+        self.sysdata = SystemData()
+        self.dropped = 0        # Autosend events dropped by listener
+        self.stats = None       # Stats of commands, None disables collecting
+        self.trace = None       # WireTrace of port traffic
+        self.remote = False     # Commands go to remote station (MODE_REMOTE)
+        self.dev = None         # Port
+        self.speed = None       # Baudrate of port
+        self.upgrade = False    # Raise 4800 Bd station to 38400 Bd for bulk transfers
+        self.cpcok = False      # CPC was read from the station addressed now
 
     def __str__(self):
         s  = (f"SI master station at {self.tty}:\n"
               f"    Speed: {self.speed}\n"
               f"    CN: {self.cn}\n"
-              f"    Tries: {self.handshake_tries}\n"
+              f"    Retry: {self.retry}\n"
               f"    CPC: {self.cpc}\n"
               f"        ExtProt: {self.extprot}\n"
               f"        AutoSend: {self.autosend}\n"
@@ -200,6 +985,17 @@ class Si():
               f"        PunchRead: {self.punchread}\n")
         return s
 
+    @property
+    def handshake_tries(self):
+        '''Number of tries of the retry policy.'''
+        return self.retry.tries
+
+    @handshake_tries.setter
+    def handshake_tries(self, tries):
+        '''Set number of tries on own copy of the policy (it may be shared).'''
+        self.retry = copy.copy(self.retry)
+        self.retry.tries = tries
+
     def frame(self, command, data):
         '''Add framing to output data.'''
         length = len(data)
@@ -212,108 +1008,756 @@ class Si():
         return
 
     def unframe(self):
-        '''Strip framing from input data.'''
-        while len(self.rdata) > 0:
-            d = self.rdata.pop(0)
-            if d == STX: break
-            elif d == NAK:
-                self.status = NAK
-                return self.status
-            elif d == ACK:
-                self.status = ACK
+        '''Take next frame from decoder, strip framing from input data.'''
+        badcrc = self.decoder.badcrc
+        frame = self.replies.popleft() if self.replies else self.decoder.next()
+        if frame is None:
+            if self.decoder.badcrc > badcrc:
+                self.status = BADCRC
+            else:
+                self.status = NODATA
+            return self.status
+        if frame.cn is None:
+            if frame.command in (NAK, ACK):
+                self.status = frame.command
                 return self.status
-            d = self.rdata.pop(0)
+            self.rdata = bytearray((frame.command, len(frame.data)))
         else:
-            self.status = NODATA
-            return self.status
+            self.rdata = bytearray((frame.command, len(frame.data) + 2, frame.cn >> 8, frame.cn & 0xff))
+        self.rdata.extend(frame.data)
+        self.status = DATAOK
+        return self.status
 
-        if self.checkcrc():
-            self.status = DATAOK
+    def setcpc(self, cpc):
+        '''Save protocol info (CPC byte) to properties.'''
+        self.cpc = cpc
+        self.extprot = bool(self.cpc & 0x01)
+        self.autosend = bool(self.cpc & 0x02)
+        self.handshk = bool(self.cpc & 0x04)
+        self.password = bool(self.cpc & 0x10)
+        self.punchread = bool(self.cpc & 0x80)
+
+    def loadcache(self, cache):
+        '''Load port cache entry, return baud rates in order to try.'''
+        self.cache = StateFile(cache) if cache else None
+        self.cachekey = port_key(self.tty)
+        self.cached = self.cache.get(self.cachekey, {}) if self.cache else {}
+        bauds = (38400, 4800)
+        speed = self.cached.get('speed')
+        if speed in bauds:
+            bauds = (speed,) + tuple(b for b in bauds if b != speed)
+        return bauds
+
+    def savecache(self, drop=False):
+        '''Store working speed and CPC of master station to port cache (or drop the entry).'''
+        if self.cache is None: return
+        if self.remote and not drop: return     # CPC is of remote station
+        if drop:
+            if self.cachekey not in self.cache.data: return
+            del self.cache[self.cachekey]
         else:
-            self.status = BADCRC
-        return self.status
+            entry = {'speed': self.speed, 'cpc': self.cpc}
+            if self.cache.get(self.cachekey) == entry: return
+            self.cache[self.cachekey] = entry
+        try:
+            self.cache.save()
+        except OSError as e:
+            logging.warning("Port cache not saved: {}".format(e))
+
+    def sysrequest(self, offset, length, whole):
+        '''Span of system data to read for readsys (offset, length) or None.'''
+        span = self.sysdata.missing(offset, length)
+        if span and whole and not self.sysdata.full:
+            span = (0, SYSDATA_SIZE)
+        return span
 
-    def checkcrc(self):
-        '''Check CRC of received data.'''
-        length = self.rdata[1]
-        data_crc = (self.rdata[length+2] << 8) + self.rdata[length+3]
-        comp_crc = crc_l(length+2, self.rdata)
-        if data_crc == comp_crc:
-            return True
+    def sysreply(self, offset, length):
+        '''Store C_GETDATA reply to snapshot.'''
+        if self.rdata[4] != offset or len(self.rdata) - 5 < length:
+            raise SiException('Unexpected system data reply.')
+        self.sysdata.update(offset, self.rdata[5:5+length])
+
+    def getprot(self):
+        '''Communication protocol info.'''
+        return {'cpc': self.cpc,
+                'extprot': self.extprot,
+                'autosend': self.autosend,
+                'handshk': self.handshk,
+                'password': self.password,
+                'punchread': self.punchread}
+
+    def dispatch(self, events):
+        '''Move autosend events from decoder to bounded queue, drop the oldest on overflow.
+           Other frames (replies to commands) are kept for unframe.'''
+        for frame in self.decoder:
+            event = autosend_event(frame)
+            if event is None:
+                self.replies.append(frame)
+                continue
+            try:
+                events.put_nowait(event)
+            except (queue.Full, asyncio.QueueFull):
+                events.get_nowait()
+                self.dropped += 1
+                events.put_nowait(event)
+
+    def cardreply(self, command, bn):
+        '''Card data from C_GETSI5 / C_GETSI6 / C_GETSI8 reply.'''
+        if command == C_GETSI5:
+            data = self.rdata[4:4+CARD_BLOCK]
+        elif self.rdata[4] != bn:
+            raise SiException('Unexpected card block {} (expected {}).'.format(self.rdata[4], bn))
         else:
-            logging.warning("Bad CRC. Received: {}, Computed: {}".format(data_crc, comp_crc))
+            data = self.rdata[5:5+CARD_BLOCK]
+        if self.rdata[0] != command or len(data) < CARD_BLOCK:
+            raise SiException('Unexpected card data reply.')
+        return bytes(data)
+
+    def opened(self, baudrate):
+        '''Record port open to trace.'''
+        if self.trace is not None:
+            self.trace.record(TRACE_OPEN, baudrate.to_bytes(4, 'big'))
+
+    def switched(self, mode):
+        '''Record switch to MODE_LOCAL or MODE_REMOTE, protocol info and system data
+           are read again from the station addressed now.'''
+        self.remote = mode == MODE_REMOTE
+        self.cpcok = False
+        self.sysdata.invalidate()
+
+    def readtimeout(self, baudrate):
+        '''Upper bound of one read: timeout plus transmission of the longest frame.'''
+        return self.timeout + SI_FRAMEMAX * 10 / baudrate
+
+    ## Protocol steps ## ---------------
+    # Generators yielding I/O steps (IO_* tuples) and receiving their results,
+    # run by Si.run and AsyncSi.run, so the protocol is the same for both.
+
+#--------------------------------#
+    def open_steps(self, cache):
+        '''Find speed the master station answers at (cached speed first) and
+           set it to local mode. Cached protocol info is confirmed lazily.'''
+        for baudrate in self.loadcache(cache):
+            yield (IO_OPEN, baudrate)
+            try:
+                yield from self.handshake_steps(C_SETMSMODE, (MODE_LOCAL,), 1)
+            except SiException: continue
+            break
+        else:
+            yield (IO_CLOSE,)
+            self.savecache(drop=True)
+            raise SiException("Cannot set baudrate.")
+
+        self.cn = (self.rdata[2] << 8) + self.rdata[3]
+        if self.cached.get('speed') == baudrate and 'cpc' in self.cached:
+            self.setcpc(self.cached['cpc'])
+            self.cpcok = False
+        else:
+            yield from self.refreshprot_steps()
+
+#--------------------------------#
+    def handshake_steps(self, command, data=(), tries=0):
+        """Try write - read cycle, retries are driven by retry policy.
+           Data may be callable, it is evaluated for each try.
+           Nonzero tries overrides number of tries of the policy."""
+        policy = self.retry
+        stats = self.stats
+        if tries == 0: tries = policy.tries
+        start = time.monotonic()
+        attempt = naks = 0
+        if stats is not None: stats.start(command)
+        while True:
+            if stats is not None: sent = time.monotonic()
+            yield (IO_WRITE, command, data() if callable(data) else data)
+            status = yield (IO_READ,)
+            while status == DATAOK and self.rdata[0] != command:
+                logging.debug("Reply to 0x{:02x} skipped (late or autosend).".format(self.rdata[0]))
+                status = yield (IO_READ,)
+            if stats is not None: stats.attempt(len(self.wdata), status, time.monotonic() - sent)
+            if status == DATAOK:
+                break
+            attempt += 1
+            if status == NAK: naks += 1
+            delay = None
+            if attempt < tries:
+                delay = policy.wait(attempt, naks, status, time.monotonic() - start)
+            if delay is None:
+                if stats is not None: stats.done(False)
+                raise SiException('Handshake failed, no tries left.')
+            logging.warning("{}: Bad status 0x{:02x}, {} tries left.".format(self.tty, status, tries - attempt))
+            if delay:
+                if stats is not None: stats.sleep(delay)
+                yield (IO_SLEEP, delay)
+        if stats is not None: stats.done(True)
+
+#--------------------------------#
+    def setime_steps(self, tries=0):
+        '''
+        Set station time to computer time.
+        Timestamp is taken again for each try.
+        '''
+        yield from self.handshake_steps(C_SETTIME, lambda: timedata(datetime.now()), tries)
+        logging.debug("Time set successfully.")
+
+#--------------------------------#
+    def timeprobe_steps(self):
+        '''Read station time, return (station - computer time, round trip time) in seconds.
+           Station is assumed to read its clock in the middle of the round trip.'''
+        sent = datetime.now()
+        start = time.monotonic()
+        yield from self.handshake_steps(C_GETTIME)
+        rtt = time.monotonic() - start
+        station = clock_time(self.rdata[4:11])
+        return ((station - sent).total_seconds() - rtt / 2, rtt)
+
+#--------------------------------#
+    def synctime_steps(self, probes=SYNC_PROBES, tries=0):
+        '''
+        Set station time to computer time compensated for transit time.
+        Round trip is measured by probes C_GETTIME commands (the fastest one
+        is used), time is sent ahead by half of it and checked by one read back.
+        Returns remaining offset (station - computer time) in seconds.
+        '''
+        rtts = []
+        for i in range(probes):
+            rtts.append((yield from self.timeprobe_steps())[1])
+        ahead = timedelta(seconds=min(rtts) / 2)
+        yield from self.handshake_steps(C_SETTIME, lambda: timedata(datetime.now() + ahead), tries)
+        offset, check = yield from self.timeprobe_steps()
+        logging.info("{}: Time synced, round trip {:.1f} ms, offset {:+.1f} ms.".format(
+            self.tty, min(rtts) * 1000, offset * 1000))
+        return offset
+
+#--------------------------------#
+    def findspeed_steps(self, bauds):
+        '''Find speed the station answers at (C_SETSPEED to the same speed),
+           trying bauds in order (as many rounds as tries of retry policy),
+           and leave the port at it.'''
+        for attempt in range(self.retry.tries):
+            for baudrate in bauds:
+                yield (IO_OPEN, baudrate)
+                try:
+                    yield from self.handshake_steps(C_SETSPEED, (SPEED_CODES[baudrate],), 1)
+                except SiException:
+                    continue
+                logging.info("{}: Station found at {} Bd.".format(self.tty, baudrate))
+                return baudrate
+        raise SiException("Station does not answer at any speed.")
+
+#--------------------------------#
+    def setspeed_steps(self, baudrate):
+        '''
+        Switch station and port to baudrate, confirmed by command at the new speed.
+        If anything fails the station is searched at both speeds, so the port
+        is left at the speed the station answers at. If it does not answer
+        at all, the port is left at the former speed. Returns speed in use.
+        '''
+        former = self.speed
+        try:
+            yield from self.handshake_steps(C_SETSPEED, (SPEED_CODES[baudrate],))
+            yield (IO_OPEN, baudrate)
+            yield from self.handshake_steps(C_SETSPEED, (SPEED_CODES[baudrate],), 1)
+        except SiException as e:
+            logging.warning("{}: Speed change to {} Bd failed: {}".format(self.tty, baudrate, e))
+            try:
+                return (yield from self.findspeed_steps(sorted(SPEED_CODES, key=lambda b: b != baudrate)))
+            except SiException:
+                yield (IO_OPEN, former)
+                raise
+        logging.debug("Speed set to {} Bd.".format(baudrate))
+        return baudrate
+
+#--------------------------------#
+    def upgrade_steps(self, length=HIGHSPEED_MIN):
+        '''
+        Raise speed to 38400 Bd for transfer of length bytes if upgrade is on
+        and station was found at 4800 Bd. Returns True if restore_steps are
+        to follow the transfer. Failed upgrade is not an error, the transfer
+        runs at the speed in use and upgrade is turned off for this station
+        (no retry on every transfer).
+        '''
+        if not self.upgrade or self.speed != 4800 or length < HIGHSPEED_MIN:
             return False
+        if (yield from self.setspeed_steps(38400)) == 4800:
+            logging.info("{}: Station stays at 4800 Bd, upgrade turned off.".format(self.tty))
+            self.upgrade = False
+        return True
+
+    def restore_steps(self):
+        '''Return station to 4800 Bd after upgrade_steps.'''
+        if self.speed != 4800:
+            yield from self.setspeed_steps(4800)
+
+#--------------------------------#
+    def readsys_steps(self, offset=0, length=SYSDATA_SIZE, whole=True, tries=0):
+        '''Return system data bytes, read from station only what is not in snapshot.
+           Snapshot not read whole yet is read whole in one C_GETDATA (unless whole is False).
+           Nonzero tries overrides number of tries of the retry policy.'''
+        span = self.sysrequest(offset, length, whole)
+        if span:
+            yield from self.handshake_steps(C_GETDATA, span, tries)
+            self.sysreply(*span)
+        return self.sysdata.get(offset, length)
+
+#--------------------------------#
+    def setsys_steps(self, offset, data):
+        '''Write system data, invalidate written bytes of snapshot.'''
+        self.sysdata.invalidate(offset, len(data))
+        yield from self.handshake_steps(C_SETDATA, (offset,) + tuple(data))
+
+#--------------------------------#
+    def refreshprot_steps(self):
+        '''Read protocol info and save it to properties'''
+        self.sysdata.invalidate(O_PROT, 1)
+        self.setcpc((yield from self.readsys_steps(O_PROT, 1, whole=False))[0])
+        self.cpcok = True
+        self.savecache()
+
+#--------------------------------#
+    def confirmprot_steps(self):
+        '''Read protocol info if it was not read from the station addressed now
+           (it was taken from cache or the station was switched).'''
+        if not self.cpcok:
+            yield from self.refreshprot_steps()
+
+#--------------------------------#
+    def readblock_steps(self, command, bn):
+        '''Read one block of card data.'''
+        if command == C_GETSI5:
+            yield from self.handshake_steps(command)
+        else:
+            yield from self.handshake_steps(command, (bn,))
+        return self.cardreply(command, bn)
+
+#--------------------------------#
+    def readcard_steps(self, cardtype, start=0, ack=True):
+        '''Read card inserted in readout station (cardtype as in insert Event).
+           Block 0 is read first, then only blocks holding punches.
+           Readout is confirmed by ACK (station beeps) unless ack is False.'''
+        command = CARD_COMMANDS.get(cardtype, C_GETSI8)
+        if command == C_GETSI5:
+            blocks = {0: (yield from self.readblock_steps(command, 0))}
+        else:
+            upgraded = yield from self.upgrade_steps()
+            try:
+                blocks = {0: (yield from self.readblock_steps(command, 0))}
+                for bn in card_blocks(command, blocks[0]):
+                    blocks[bn] = yield from self.readblock_steps(command, bn)
+            finally:
+                if upgraded: yield from self.restore_steps()
+        if ack:
+            yield (IO_ACK,)
+        return parse_card(command, blocks, start)
+
+##################################
+# SI main class
+##################################
+class Si(SiBase):
+    '''SI master station class'''
+    def __init__(self, tty, retry=None, cache=PORT_CACHE, stats=None, trace=None, transport=None,
+                 upgrade=False):
+        '''Initialize serial communication with SI master station.
+           Speed and protocol info of the last session are taken from port
+           cache (None disables it), cached protocol info is confirmed lazily.
+           Command statistics are collected to stats (Stats) if given,
+           port traffic is recorded to trace (WireTrace) if given.
+           Transport opens the port (default serial.Serial, see ReplaySerial).
+           Upgrade raises station found at 4800 Bd to 38400 Bd for bulk transfers.'''
+        super().__init__(tty, retry)
+        self.stats = stats
+        self.trace = trace
+        self.upgrade = upgrade
+        self.transport = transport or serial.Serial
+        self.run(self.open_steps(cache))
+
+    def close(self):
+        '''Close serial port.'''
+        if self.dev is not None:
+            self.dev.close()
+
+#--------------------------------#
+    def run(self, steps):
+        '''Do I/O steps of protocol generator (see SiBase), return its result.
+           Exceptions of I/O are raised inside the generator.'''
+        send, value = steps.send, None
+        while True:
+            try:
+                step = send(value)
+            except StopIteration as stop:
+                return stop.value
+            send = steps.send
+            try:
+                op = step[0]
+                if op == IO_READ:
+                    value = self.siread()
+                elif op == IO_WRITE:
+                    value = self.siwrite(step[1], step[2])
+                elif op == IO_SLEEP:
+                    value = time.sleep(step[1])
+                elif op == IO_OPEN:
+                    value = self.reopen(step[1])
+                elif op == IO_CLOSE:
+                    value = self.close()
+                else:
+                    value = self.sendack()
+            except BaseException as e:
+                send, value = steps.throw, e
 
 #--------------------------------#
     def siread(self):
-        """Read data from SI station."""
-        self.rdata = bytearray(self.dev.read(SI_CHUNK))
-        if self.rdata:
-            logging.debug("<i<<< " + ':'.join('{:02x}'.format(x) for x in self.rdata))
-        return self.unframe()
+        """Read data from SI station.
+
+        Reads only the bytes missing to complete a frame (LEN is parsed from
+        the frame header), so it returns as soon as the frame arrives.
+        Serial timeout bounds the waiting for the next data, the whole read
+        is bounded by the timeout plus transmission time of the longest frame.
+        """
+        dev = self.dev
+        deadline = time.monotonic() + self.readtimeout(dev.baudrate)
+        while True:
+            status = self.unframe()
+            if status != NODATA or time.monotonic() > deadline:
+                break
+            data = dev.read(self.decoder.missing() or 1)
+            if data:
+                waiting = dev.in_waiting
+                if waiting: data += dev.read(waiting)
+            if self.trace is not None: self.trace.record(TRACE_IN, data)
+            if not data: break          # Timeout
+            logdata("<i<<< ", data)
+            if self.stats is not None: self.stats.received(len(data))
+            self.decoder.feed(data)
+        while status == NODATA and self.decoder.missing():
+            self.decoder.resync()       # Frame in progress started by noise
+            status = self.unframe()
+        return status
 
 #--------------------------------#
     def siwrite(self, command, data=()):
         """Write data to SI station."""
         self.frame(command, data)
+        self.decoder.clear()        # Drop stale replies
+        self.replies.clear()
         self.dev.write(self.wdata)
-        logging.debug(">o>>> " + ':'.join('{:02x}'.format(x) for x in self.wdata))
+        if self.trace is not None: self.trace.record(TRACE_OUT, self.wdata)
+        logdata(">o>>> ", self.wdata)
         return
 
 #--------------------------------#
-    def handshake(self, command, data=(), tries=0):
-        """Try write - read cycle tries times."""
-        if tries == 0: tries = self.handshake_tries
-        while tries > 0:
-            self.siwrite(command, data)
-            if self.siread() == DATAOK:
-                break
-            else:
-                tries -= 1
-                logging.warning("Bad status, {} tries left.".format(tries))
-                if tries > 0: time.sleep(1)
-        else:
-            raise SiException('Handshake failed, no tries left.')
+    def sendack(self):
+        '''Write ACK byte (confirms card readout).'''
+        self.dev.write(bytes((ACK,)))
+        if self.trace is not None: self.trace.record(TRACE_OUT, bytes((ACK,)))
+
+#--------------------------------#
+    def reopen(self, baudrate):
+        '''(Re)open port at baudrate.'''
+        self.close()
+        self.dev = self.transport('/dev/'+self.tty, baudrate, timeout=self.timeout)
+        self.opened(baudrate)
+        self.speed = baudrate
 
 #--------------------------------#
+    def handshake(self, command, data=(), tries=0):
+        """Try write - read cycle, see SiBase.handshake_steps."""
+        self.run(self.handshake_steps(command, data, tries))
+
     def setime(self, tries=0):
+        '''Set station time to computer time.'''
+        self.run(self.setime_steps(tries))
+
+    def timeprobe(self):
+        '''Read station time, see SiBase.timeprobe_steps.'''
+        return self.run(self.timeprobe_steps())
+
+    def synctime(self, probes=SYNC_PROBES, tries=0):
+        '''Set station time compensated for transit time, see SiBase.synctime_steps.'''
+        return self.run(self.synctime_steps(probes, tries))
+
+    def findspeed(self, bauds):
+        '''Find speed the station answers at, see SiBase.findspeed_steps.'''
+        return self.run(self.findspeed_steps(bauds))
+
+    def setspeed(self, baudrate):
+        '''Switch station and port to baudrate, see SiBase.setspeed_steps.'''
+        return self.run(self.setspeed_steps(baudrate))
+
+    @contextmanager
+    def highspeed(self, length=HIGHSPEED_MIN):
+        '''Run block of length bytes transfer at 38400 Bd, see SiBase.upgrade_steps.'''
+        upgraded = self.run(self.upgrade_steps(length))
+        try:
+            yield
+        finally:
+            if upgraded: self.run(self.restore_steps())
+
+    def readsys(self, offset=0, length=SYSDATA_SIZE, whole=True, tries=0):
+        '''Return system data bytes, see SiBase.readsys_steps.'''
+        return self.run(self.readsys_steps(offset, length, whole, tries))
+
+    def setsys(self, offset, data):
+        '''Write system data, invalidate written bytes of snapshot.'''
+        self.run(self.setsys_steps(offset, data))
+
+    def refreshprot(self):
+        '''Read protocol info and save it to properties'''
+        self.run(self.refreshprot_steps())
+
+    def confirmprot(self):
+        '''Read protocol info if it was not read from the station addressed now.'''
+        self.run(self.confirmprot_steps())
+
+    def readblock(self, command, bn):
+        '''Read one block of card data.'''
+        return self.run(self.readblock_steps(command, bn))
+
+    def readcard(self, cardtype, start=0, ack=True):
+        '''Read card inserted in readout station, see SiBase.readcard_steps.'''
+        return self.run(self.readcard_steps(cardtype, start, ack))
+
+#--------------------------------#
+    def listen(self, timeout=None, maxqueue=LISTEN_QUEUE):
+        '''Generator of autosend events (punches, cards inserted and removed).
+
+        Port is read by background thread into bounded queue, so reading
+        keeps up with the station even if the consumer is slow. When the
+        queue is full the oldest events are dropped and counted in dropped.
+        Ends after timeout seconds without event (None waits forever).
         '''
-        Set station time to computer time.
-        Try to count difference with multiple tries.
-        '''
-        if tries == 0: tries = self.handshake_tries
-        while tries > 0:
-            t = datetime.now()
-            if t.hour >= 12:
-                is_pm = 1
-                hour = t.hour - 12
-            else:
-                is_pm = 0
-                hour = t.hour
-            td = ((t.isoweekday() % 7) << 1) + is_pm
-            secs = hour * 3600 + t.minute * 60 + t.second
-            tss = round(t.microsecond * 256 / 1000000)
-            data = (t.year % 100, t.month, t.day, td, (secs >> 8) & 0xff, secs & 0xff, tss)
-            self.siwrite(C_SETTIME, data)
-            if self.siread() == DATAOK:
+        events = queue.Queue(maxqueue)
+        stop = threading.Event()
+        failed = []
+        self.dropped = 0
+
+        def reader():
+            dev = self.dev
+            while not stop.is_set():
+                try:
+                    data = dev.read(self.decoder.missing() or 1)
+                    if not data: continue
+                    waiting = dev.in_waiting
+                    if waiting: data += dev.read(waiting)
+                except serial.SerialException as e:
+                    failed.append(e)
+                    events.put(None)
+                    return
+                if self.trace is not None: self.trace.record(TRACE_IN, data)
+                logdata("<i<<< ", data)
+                self.decoder.feed(data)
+                self.dispatch(events)
+
+        self.decoder.clear()
+        thread = threading.Thread(target=reader, name='listen-' + self.tty, daemon=True)
+        thread.start()
+        try:
+            while True:
+                try:
+                    event = events.get(timeout=timeout)
+                except queue.Empty:
+                    return
+                if event is None:
+                    raise SiException("Listening on {} failed: {}".format(self.tty, failed[0]))
+                yield event
+        finally:
+            stop.set()
+            thread.join()
+
+
+##################################
+# SI station with asyncio transport
+##################################
+class AsyncSi(SiBase):
+    '''SI master station class for asyncio.
+
+    Serial port is used in non-blocking mode and read by event loop
+    reader callback, so one loop can drive several stations. Port without
+    file descriptor (e.g. ReplaySerial) is read directly by siread. Create
+    instances with: si = await AsyncSi.open(tty)
+    '''
+    def __init__(self, tty, retry=None):
+        super().__init__(tty, retry)
+        self.received = asyncio.Event()
+        self.events = None      # Queue of autosend events while listening
+        self.polled = False     # Port is not watched by event loop
+
+    @classmethod
+    async def open(cls, tty, retry=None, cache=PORT_CACHE, stats=None, trace=None, transport=None,
+                   upgrade=False):
+        '''Initialize serial communication with SI master station, see Si.'''
+        self = cls(tty, retry)
+        self.stats = stats
+        self.trace = trace
+        self.upgrade = upgrade
+        self.transport = transport or serial.Serial
+        await self.run(self.open_steps(cache))
+        return self
+
+    def reopen(self, baudrate):
+        '''(Re)open serial port at baudrate and register it in event loop.'''
+        self.close()
+        self.dev = self.transport('/dev/'+self.tty, baudrate, timeout=0)
+        self.polled = not hasattr(self.dev, 'fileno')
+        if not self.polled:
+            asyncio.get_running_loop().add_reader(self.dev.fileno(), self.readable)
+        self.opened(baudrate)
+        self.speed = baudrate
+
+    def close(self):
+        '''Unregister and close serial port.'''
+        if self.dev is not None:
+            if not self.polled:
+                asyncio.get_running_loop().remove_reader(self.dev.fileno())
+            self.dev.close()
+            self.dev = None
+
+    def readable(self):
+        '''Event loop callback, feed available data to decoder. Returns data read.'''
+        try:
+            data = self.dev.read(self.dev.in_waiting or 1)
+        except serial.SerialException as e:
+            logging.error("Read from {} failed: {}".format(self.tty, e))
+            return b''
+        if data:
+            if self.trace is not None: self.trace.record(TRACE_IN, data)
+            logdata("<i<<< ", data)
+            if self.stats is not None: self.stats.received(len(data))
+            self.decoder.feed(data)
+            if self.events is not None:
+                self.dispatch(self.events)
+            self.received.set()
+        return data
+
+#--------------------------------#
+    async def run(self, steps):
+        '''Do I/O steps of protocol generator (see SiBase), return its result.
+           Exceptions of I/O are raised inside the generator.'''
+        send, value = steps.send, None
+        while True:
+            try:
+                step = send(value)
+            except StopIteration as stop:
+                return stop.value
+            send = steps.send
+            try:
+                op = step[0]
+                if op == IO_READ:
+                    value = await self.siread()
+                elif op == IO_WRITE:
+                    value = self.siwrite(step[1], step[2])
+                elif op == IO_SLEEP:
+                    value = await asyncio.sleep(step[1])
+                elif op == IO_OPEN:
+                    value = self.reopen(step[1])
+                elif op == IO_CLOSE:
+                    value = self.close()
+                else:
+                    value = self.sendack()
+            except BaseException as e:
+                send, value = steps.throw, e
+
+#--------------------------------#
+    async def siread(self):
+        """Wait for frame from SI station, timeouts as in Si.siread."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.readtimeout(self.dev.baudrate)
+        while True:
+            status = self.unframe()
+            remain = deadline - loop.time()
+            if status != NODATA or remain <= 0:
                 break
-            else:
-                tries -= 1
-                logging.warning("Bad status, {} tries left.".format(tries))
-                if tries > 0: time.sleep(1)
-        else:
-            raise SiException('Settime failed, no tries left.')
+            if self.polled:
+                if not self.readable(): break   # Empty read is timeout
+                continue
+            self.received.clear()
+            try:
+                await asyncio.wait_for(self.received.wait(), min(remain, self.timeout))
+            except asyncio.TimeoutError:
+                break
+        while status == NODATA and self.decoder.missing():
+            self.decoder.resync()       # Frame in progress started by noise
+            status = self.unframe()
+        return status
 
-        logging.debug("Time set successfully.")
+#--------------------------------#
+    def siwrite(self, command, data=()):
+        """Write data to SI station."""
+        self.frame(command, data)
+        self.replies.clear()        # Drop stale replies
+        if self.events is None:     # Autosend frame may be in progress while listening
+            self.decoder.clear()
+        self.dev.write(self.wdata)
+        if self.trace is not None: self.trace.record(TRACE_OUT, self.wdata)
+        logdata(">o>>> ", self.wdata)
+        return
 
 #--------------------------------#
-    def refreshprot(self):
+    def sendack(self):
+        '''Write ACK byte (confirms card readout).'''
+        self.dev.write(bytes((ACK,)))
+        if self.trace is not None: self.trace.record(TRACE_OUT, bytes((ACK,)))
+
+#--------------------------------#
+    async def handshake(self, command, data=(), tries=0):
+        """Try write - read cycle, see SiBase.handshake_steps."""
+        await self.run(self.handshake_steps(command, data, tries))
+
+    async def setime(self, tries=0):
+        '''Set station time to computer time.'''
+        await self.run(self.setime_steps(tries))
+
+    async def timeprobe(self):
+        '''Read station time, see SiBase.timeprobe_steps.'''
+        return await self.run(self.timeprobe_steps())
+
+    async def synctime(self, probes=SYNC_PROBES, tries=0):
+        '''Set station time compensated for transit time, see SiBase.synctime_steps.'''
+        return await self.run(self.synctime_steps(probes, tries))
+
+    async def findspeed(self, bauds):
+        '''Find speed the station answers at, see SiBase.findspeed_steps.'''
+        return await self.run(self.findspeed_steps(bauds))
+
+    async def setspeed(self, baudrate):
+        '''Switch station and port to baudrate, see SiBase.setspeed_steps.'''
+        return await self.run(self.setspeed_steps(baudrate))
+
+    async def readsys(self, offset=0, length=SYSDATA_SIZE, whole=True, tries=0):
+        '''Return system data bytes, see SiBase.readsys_steps.'''
+        return await self.run(self.readsys_steps(offset, length, whole, tries))
+
+    async def setsys(self, offset, data):
+        '''Write system data, invalidate written bytes of snapshot.'''
+        await self.run(self.setsys_steps(offset, data))
+
+    async def refreshprot(self):
         '''Read protocol info and save it to properties'''
-        self.handshake(C_GETDATA, (O_PROT, 1), 3)     # Get protocol information
-        self.cpc = self.rdata[5]
-        self.extprot = bool(self.cpc & 0x01)
-        self.autosend = bool(self.cpc & 0x02)
-        self.handshk = bool(self.cpc & 0x04)
-        self.password = bool(self.cpc & 0x10)
-        self.punchread = bool(self.cpc & 0x80)
+        await self.run(self.refreshprot_steps())
 
+    async def confirmprot(self):
+        '''Read protocol info if it was not read from the station addressed now.'''
+        await self.run(self.confirmprot_steps())
+
+    async def readblock(self, command, bn):
+        '''Read one block of card data.'''
+        return await self.run(self.readblock_steps(command, bn))
+
+    async def readcard(self, cardtype, start=0, ack=True):
+        '''Read card inserted in readout station, see SiBase.readcard_steps.'''
+        return await self.run(self.readcard_steps(cardtype, start, ack))
+
+#--------------------------------#
+    async def listen(self, timeout=None, maxqueue=LISTEN_QUEUE):
+        '''Async iterator of autosend events, see Si.listen.
+           Frames are decoded to events in the reader callback.'''
+        self.events = asyncio.Queue(maxqueue)
+        self.dropped = 0
+        self.decoder.clear()
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(self.events.get(), timeout)
+                except asyncio.TimeoutError:
+                    return
+                yield event
+        finally:
+            self.events = None